@@ -1,28 +1,14 @@
 import os
 import sys
 import argparse
-from tkinter import Tk, filedialog
 import json
 
-import ipdb
-import numpy as np
 from matplotlib import cm
 import matplotlib.pyplot as plt
-from skimage import io, feature, color, transform
 
-st = ipdb.set_trace
-
-def read_image(path):
-    image = io.imread(path)
-    return image
-
-def get_canny_edges(image, sigma):
-    edges = feature.canny(color.rgb2gray(image), sigma=sigma)
-    return edges
-
-def get_hough_lines(edges, line_length, line_gap):
-    lines = transform.probabilistic_hough_line(edges, line_length=line_length, line_gap=line_gap)
-    return np.asarray(lines)
+# The detection pipeline is shared with the web backend
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "web", "backend"))
+from vp_detection import VanishingPointPipeline
 
 def visualize_inliers(image, edges, lines, inlier_lines_list, colors, fig_name='detected_lines.png'):
     subplot_count = len(inlier_lines_list) + 3
@@ -67,7 +53,8 @@ def visualize_vanishing_points(vp_height, vp_length, vp_width, image, lines, edg
             p0, p1 = line
             plt.plot((p0[0], p1[0]), (p0[1], p1[1]), colors[i])
 
-        plt.plot([vps[i][0]], [vps[i][1]], colors[i]+'X', markersize=5)
+        if vps[i] is not None:
+            plt.plot([vps[i][0]], [vps[i][1]], colors[i]+'X', markersize=5)
         plt.axis('off')
         plt.tight_layout()
         plt.savefig(fig_name.split('.')[0] + str(i) + '.png') 
@@ -79,91 +66,44 @@ def visualize_vanishing_points(vp_height, vp_length, vp_width, image, lines, edg
             p0, p1 = line
             plt.plot((p0[0], p1[0]), (p0[1], p1[1]), colors[i])
 
-    plt.plot([vps[0][0]], [vps[0][1]], colors[0]+'X', markersize=5)
-    plt.plot([vps[1][0]], [vps[1][1]], colors[1]+'X', markersize=5)
-    plt.plot([vps[2][0]], [vps[2][1]], colors[2]+'X', markersize=5)
+    for i, vp in enumerate(vps):
+        if vp is not None:
+            plt.plot([vp[0]], [vp[1]], colors[i]+'X', markersize=5)
     plt.axis('off')
     plt.tight_layout()
     plt.savefig(fig_name) 
     plt.close() 
 
-def calculate_metric_angle(current_hypothesis, lines, ignore_pts, ransac_angle_thresh):
-    current_hypothesis = current_hypothesis / current_hypothesis[-1]
-    hypothesis_vp_direction = current_hypothesis[:2] - lines[:,0]
-    lines_vp_direction = lines[:,1] - lines[:,0]
-    magnitude = np.linalg.norm(hypothesis_vp_direction, axis=1) * np.linalg.norm(lines_vp_direction, axis=1)
-    magnitude[magnitude == 0] = 1e-5
-    cos_theta = (hypothesis_vp_direction*lines_vp_direction).sum(axis=-1) / magnitude
-    theta = np.arccos(np.abs(cos_theta))
-    inliers = (theta < ransac_angle_thresh * np.pi / 180)
-    inliers[ignore_pts] = False
-    return inliers, inliers.sum()
-
-def run_line_ransac(lines, ransac_iter, ransac_angle_thresh, ignore_pts=None):
-    best_vote_count = 0
-    best_inliers = None
-    best_hypothesis = None
-    if ignore_pts is None:
-        ignore_pts = np.zeros((lines.shape[0])).astype('bool')
-        lines_to_chose = np.arange(lines.shape[0])
-    else:
-        lines_to_chose = np.where(ignore_pts==0)[0]
-    for iter_count in range(ransac_iter):
-        idx1, idx2 = np.random.choice(lines_to_chose, 2, replace=False)
-        l1 = np.cross(np.append(lines[idx1][1], 1), np.append(lines[idx1][0], 1))
-        l2 = np.cross(np.append(lines[idx2][1], 1), np.append(lines[idx2][0], 1))
-
-        current_hypothesis = np.cross(l1, l2)
-        if current_hypothesis[-1] == 0:
-            continue
-        inliers, vote_count = calculate_metric_angle(current_hypothesis, lines, ignore_pts, ransac_angle_thresh)
-        if vote_count > best_vote_count:
-            best_vote_count = vote_count
-            best_hypothesis = current_hypothesis
-            best_inliers = inliers
-    return best_hypothesis, best_inliers
-
-def get_vp_inliers(image_path, sigma, iterations, line_len, line_gap, threshold):
-    image = read_image(image_path)
-    edges = get_canny_edges(image, sigma=sigma)
-    lines = get_hough_lines(edges, line_length=line_len, line_gap=line_gap)
-
-    best_hypothesis_1, best_inliers_1 = run_line_ransac(lines, iterations, threshold)
-    ignore_pts = best_inliers_1
-    best_hypothesis_2, best_inliers_2 = run_line_ransac(lines, iterations, threshold, ignore_pts=ignore_pts)
-    ignore_pts = np.logical_or(best_inliers_1, best_inliers_2)
-    best_hypothesis_3, best_inliers_3 = run_line_ransac(lines, iterations, threshold, ignore_pts=ignore_pts)
-    inlier_lines_list = [best_inliers_1, best_inliers_2, best_inliers_3]
-    best_hypothesis_1 = best_hypothesis_1 / best_hypothesis_1[-1]
-    best_hypothesis_2 = best_hypothesis_2 / best_hypothesis_2[-1]
-    best_hypothesis_3 = best_hypothesis_3 / best_hypothesis_3[-1]
-    hypothesis_list = [best_hypothesis_1, best_hypothesis_2, best_hypothesis_3]
-    viz_stuff = [image, edges, lines]
-    return inlier_lines_list, hypothesis_list, viz_stuff
+# Boîte de dialogue pour choisir une image quand aucun chemin n'est donné
+def choose_image():
+    from tkinter import Tk, filedialog
 
-def main():
-    # Initialisation de la boîte de dialogue pour choisir un fichier
     root = Tk()
     root.withdraw()  # Masquer la fenêtre principale de Tkinter
-    
-    image_path = filedialog.askopenfilename(title="Choisir une image",
-                                            filetypes=[("Images", "*.jpg;*.jpeg;*.png;*.bmp")])
+    return filedialog.askopenfilename(title="Choisir une image",
+                                      filetypes=[("Images", "*.jpg;*.jpeg;*.png;*.bmp")])
+
+def main():
+    parser = argparse.ArgumentParser(description="Détection des points de fuite d'une image")
+    parser.add_argument("image", nargs="?", help="image à traiter (sinon, boîte de dialogue)")
+    parser.add_argument("--sigma", type=float, default=5)  # Valeur par défaut pour canny_sigma
+    parser.add_argument("--iterations", type=int, default=3000)  # Valeur par défaut pour ransac_iter
+    parser.add_argument("--line-len", type=int, default=11)  # Longueur minimale des lignes pour Hough
+    parser.add_argument("--line-gap", type=int, default=7)  # Espace maximal entre les lignes pour Hough
+    parser.add_argument("--threshold", type=float, default=2)  # Seuil d'angle pour RANSAC
+    parser.add_argument("--seed", type=int, default=None, help="graine pour des résultats reproductibles")
+    args = parser.parse_args()
+
+    image_path = args.image or choose_image()
     if not image_path:
         raise ValueError("Aucune image sélectionnée. Veuillez relancer le script et sélectionner une image.")
-
-    # Valeurs par défaut pour les paramètres
-    sigma = 5  # Valeur par défaut pour canny_sigma
-    iterations = 3000  # Valeur par défaut pour ransac_iter
-    line_len = 11  # Longueur minimale des lignes pour Hough
-    line_gap = 7  # Espace maximal entre les lignes pour Hough
-    threshold = 2  # Seuil d'angle pour RANSAC
+    sigma, iterations, line_len, line_gap, threshold = (args.sigma, args.iterations, args.line_len, args.line_gap,
+                                                        args.threshold)
 
     # Traitement de l'image
     img_name = os.path.basename(image_path).split('.')[0]
-    inlier_lines_list, hypothesis_list, viz_stuff = get_vp_inliers(
-        image_path, sigma, iterations, line_len, line_gap, threshold
-    )
-    image, edges, lines = viz_stuff
+    pipeline = VanishingPointPipeline(sigma, iterations, line_len, line_gap, threshold, seed=args.seed)
+    inlier_lines_list, hypothesis_list, image, edges, lines = pipeline.detect(image_path)
     best_hypothesis_1, best_hypothesis_2, best_hypothesis_3 = hypothesis_list
 
     # Génération des noms de fichiers pour les visualisations
@@ -182,9 +122,8 @@ def main():
     # Génération du fichier JSON avec les coordonnées des points de fuite
     vanishing_points_data = {
         "vanishing_points": [
-            {"vp_length": best_hypothesis_1[:2].tolist()},
-            {"vp_height": best_hypothesis_2[:2].tolist()},
-            {"vp_width": best_hypothesis_3[:2].tolist()}
+            {name: None if vp is None else vp[:2].tolist()}
+            for name, vp in zip(("vp_length", "vp_height", "vp_width"), hypothesis_list)
         ]
     }
     json_file_name = f"vanishing_points.json"
@@ -1,22 +1,49 @@
-from fastapi import FastAPI, File, UploadFile
+from contextlib import AsyncExitStack, asynccontextmanager
+from fastapi import FastAPI, File, Request, UploadFile
+from typing import List
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from starlette.routing import Match
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 import torch
-import torchvision.transforms as T
-import torchvision
-from PIL import Image
+import asyncio
+import functools
 import numpy as np
-import cv2
-import json
-from torchvision.models.detection.faster_rcnn import FastRCNNPredictor
-from torchvision.models.detection.mask_rcnn import MaskRCNNPredictor
-import io
-from vp_detection import get_vp_inliers, save_visualizations
-import tempfile
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from inference import (load_backend, linearize_detections, format_predictions, compact_output, get_tiles,
+                       merge_tile_outputs, warm_up, MIN_TILE_SIZE)
+from encoding import BINARY_MEDIA_TYPE, FastJSONResponse, dumps, loads, pack_predictions
+from imaging import decode_image
+from cache import ResultCache, image_hash, make_key
+from batching import InferenceBatcher
+from executors import BoundedExecutor, ConcurrencyLimiter, Saturated, make_executor
+from jobs import DONE, JobRunner, JobStore
+from vp_detection import SOLVERS, compute_vanishing_points
+import metrics
 
 
+# Start the inference batcher with the server and load the model in the background, then stop them
+# and the worker pools on shutdown
+@asynccontextmanager
+async def lifespan(app):
+    await batcher.start()
+    startup_task = asyncio.create_task(load_and_warm_up())
+    yield
+    startup_task.cancel()
+    await job_runner.stop()
+    job_store.close()
+    await batcher.stop()
+    torch_executor.shutdown()
+    vp_executor.shutdown()
+    linearize_pool.shutdown(wait=False)
+    if stream_manager is not None:
+        stream_manager.shutdown()
 
-app = FastAPI(redirect_slashes=False)
+app = FastAPI(redirect_slashes=False, lifespan=lifespan)
 
 #Modify the CORS settings to allow requests from the frontend
 app.add_middleware(
@@ -27,123 +54,656 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Load the trained model globally
-def load_model(weights_path, num_classes, device):
-    model = torchvision.models.detection.maskrcnn_resnet50_fpn(weights=None)
-    in_features = model.roi_heads.box_predictor.cls_score.in_features
-    model.roi_heads.box_predictor = FastRCNNPredictor(in_features, num_classes)
-    in_features_mask = model.roi_heads.mask_predictor.conv5_mask.in_channels
-    hidden_layer = 256
-    model.roi_heads.mask_predictor = MaskRCNNPredictor(in_features_mask, hidden_layer, num_classes)
-
-    # Load weights and set model to evaluation mode
-    model.load_state_dict(torch.load(weights_path, map_location=device))
-    model.to(device).eval()
-    return model
-
-# Preprocess the image
-def preprocess_image(image_data):
-    transform = T.ToTensor()
-    image = Image.open(io.BytesIO(image_data)).convert("RGB")
-    return transform(image).unsqueeze(0)  # add batch dimension
-
-# Prediction function
-def predict_and_linearize(model, image_data, device, threshold=0.5, target_class_id=10):
-    image = Image.open(io.BytesIO(image_data)).convert("RGB")
-    input_image = preprocess_image(image_data).to(device)
-
-    with torch.no_grad():
-        outputs = model(input_image)
-
-    # Extract data from outputs
-    image_np = np.array(image)
-    results = []
-    boxes = outputs[0]['boxes'].cpu().detach().numpy()
-    labels = outputs[0]['labels'].cpu().detach().numpy()
-    scores = outputs[0]['scores'].cpu().detach().numpy()
-    masks = outputs[0]['masks'].cpu().detach().numpy()
-
-    for i, score in enumerate(scores):
-        if score >= threshold and labels[i] == target_class_id:
-            box = boxes[i].astype(int)
-            mask = masks[i][0] > 0.5
-            contours, _ = cv2.findContours(mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            linearized_contours = []
-
-            valid_prediction = True  # Flag to check if the prediction should be kept
-
-            for contour in contours:
-                # Approximate contour with linear segments
-                epsilon = 0.04 * cv2.arcLength(contour, True)  # Approximation factor
-                approx = cv2.approxPolyDP(contour, epsilon, True)
-
-                if len(approx) != 4:
-                    valid_prediction = False  # Discard the prediction if any contour has more than 4 points
-                    break
-
-                linearized_contours.append(approx.reshape(-1, 2).tolist())  # Flatten contour to list of points
-
-            if not valid_prediction:
-                continue  # Skip this prediction entirely
-
-            results.append({
-                "class_id": int(labels[i]),
-                "score": float(score),
-                "bounding_box": box.tolist(),
-                "linearized_contours": linearized_contours
-            })
-
-    return results
-
-# Initialize the model
+# Per-stage durations, queue waits, image sizes and detection/line counts are exposed as histograms
+# on /metrics; with GLASSFINDER_SERVER_TIMING=1 each response also carries a Server-Timing header.
+# Nothing is installed when GLASSFINDER_METRICS=0.
+if metrics.enabled:
+    # Label requests by route template rather than raw path to keep the number of series bounded
+    def route_label(request):
+        for route in app.router.routes:
+            match, _ = route.matches(request.scope)
+            if match == Match.FULL:
+                return route.path
+        return "unmatched"
+
+    @app.middleware("http")
+    async def record_request_metrics(request, call_next):
+        endpoint_token = metrics.current_endpoint.set(route_label(request))
+        timings = [] if metrics.server_timing_enabled else None
+        timings_token = metrics.request_timings.set(timings)
+        start = time.perf_counter()
+        try:
+            response = await call_next(request)
+            metrics.record_stage("total", time.perf_counter() - start)
+        finally:
+            metrics.request_timings.reset(timings_token)
+            metrics.current_endpoint.reset(endpoint_token)
+        if timings:
+            response.headers["Server-Timing"] = metrics.format_server_timing(timings)
+        return response
+
+# Model settings. GLASSFINDER_MODEL_BACKEND selects "eager" (default), "torchscript" or "onnx";
+# the last two serve an artifact from export_model.py given by GLASSFINDER_MODEL_PATH. The model
+# itself is loaded by load_and_warm_up once the server has started.
 device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
 weights_path = "models/best_model.pth"  # Replace with your weights file path
 num_classes = 12  # Adjust according to your model
-model = load_model(weights_path, num_classes, device)
+model_backend = os.environ.get("GLASSFINDER_MODEL_BACKEND", "eager")
+model_path = os.environ.get("GLASSFINDER_MODEL_PATH", weights_path)
+model = None
+
+# Predictions on a random image of GLASSFINDER_WARMUP_SIZE (width x height) run after loading, so the
+# first request does not pay for one-time initialization (0 runs disables it)
+warmup_runs = int(os.environ.get("GLASSFINDER_WARMUP_RUNS", 1))
+warmup_width, warmup_height = (int(side) for side in os.environ.get("GLASSFINDER_WARMUP_SIZE", "640x480").split("x"))
+
+# Concurrent /predict/ uploads are grouped into batches of at most max_batch_size images,
+# waiting at most max_wait_ms for the batch to fill
+max_batch_size = int(os.environ.get("GLASSFINDER_MAX_BATCH_SIZE", 4))
+max_wait_ms = float(os.environ.get("GLASSFINDER_MAX_WAIT_MS", 10))
+
+# Blocking work runs in bounded pools: torch inference and contour extraction in threads, the VP
+# pipeline in processes. Full pools and busy endpoints answer 429 with a Retry-After hint.
+retry_after = int(os.environ.get("GLASSFINDER_RETRY_AFTER", 1))
+max_queue = int(os.environ.get("GLASSFINDER_MAX_QUEUE", 16))
+torch_executor = BoundedExecutor(
+    "torch executor", make_executor("thread", int(os.environ.get("GLASSFINDER_TORCH_WORKERS", 2))),
+    max_queue, retry_after)
+vp_workers = int(os.environ.get("GLASSFINDER_VP_WORKERS", 2))
+vp_executor = BoundedExecutor(
+    "vanishing point executor", make_executor(os.environ.get("GLASSFINDER_VP_EXECUTOR", "process"), vp_workers),
+    max_queue, retry_after)
+linearize_pool = ThreadPoolExecutor(max_workers=int(os.environ.get("GLASSFINDER_LINEARIZE_WORKERS", 4)))
+predict_limiter = ConcurrencyLimiter("/predict/", int(os.environ.get("GLASSFINDER_PREDICT_CONCURRENCY", 16)), retry_after)
+vp_limiter = ConcurrencyLimiter("/detect-vanishing-points/", int(os.environ.get("GLASSFINDER_VP_CONCURRENCY", 4)),
+                                retry_after)
+batcher = InferenceBatcher(None, device, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms,
+                           executor=torch_executor.executor, max_queue_size=max_queue, retry_after=retry_after)
+
+# Results are cached by image content hash: raw model outputs for /predict/ (so threshold and
+# target_class_id changes only redo the filtering) and final vanishing points per parameter set
+cache_dir = os.environ.get("GLASSFINDER_CACHE_DIR")
+result_cache = ResultCache(int(float(os.environ.get("GLASSFINDER_CACHE_MEMORY_MB", 256)) * 2**20),
+                           disk_dir=cache_dir,
+                           max_disk_bytes=int(float(os.environ.get("GLASSFINDER_CACHE_DISK_MB", 1024)) * 2**20))
 
+# Uploads are decoded once in memory; images whose longest side exceeds max_side are downscaled
+# before processing and results are mapped back to original pixels (unset: no downscaling)
+default_max_side = int(os.environ["GLASSFINDER_MAX_SIDE"]) if os.environ.get("GLASSFINDER_MAX_SIDE") else None
+# Threads of the joint VP solver in each VP worker (default: up to 4, bounded by the CPU count)
+vp_solver_threads = (int(os.environ["GLASSFINDER_VP_SOLVER_THREADS"])
+                     if os.environ.get("GLASSFINDER_VP_SOLVER_THREADS") else None)
+
+# Progress of streamed VP requests travels from the worker through a queue, and client disconnects
+# go back through an event. With the process executor both live in a manager process, started by the
+# first streamed request; GLASSFINDER_STREAM_POLL_MS is how often the stream checks for new events.
+stream_manager = None
+stream_poll_interval = float(os.environ.get("GLASSFINDER_STREAM_POLL_MS", 50)) / 1000
+
+async def make_progress_channel():
+    global stream_manager
+    if not isinstance(vp_executor.executor, ProcessPoolExecutor):
+        return queue.Queue(), threading.Event()
+    if stream_manager is None:
+        manager = await asyncio.get_running_loop().run_in_executor(
+            None, multiprocessing.get_context("spawn").Manager)
+        if stream_manager is None:
+            stream_manager = manager
+        else:
+            manager.shutdown()
+    return stream_manager.Queue(), stream_manager.Event()
+
+def saturated_response(e):
+    return JSONResponse(content={"error": str(e)}, status_code=429,
+                        headers={"Retry-After": str(e.retry_after)})
+
+# Startup progress reported by /health: "starting" until the model is loaded and warm and the VP
+# workers are running, then "ready" (or "failed" with the error)
+startup = {"status": "starting", "model_ready": False, "error": None, "timings": {}}
+
+async def load_and_warm_up():
+    global model
+    loop = asyncio.get_running_loop()
+    try:
+        start = time.perf_counter()
+        model = await loop.run_in_executor(torch_executor.executor, load_backend, model_backend, model_path,
+                                           num_classes, device)
+        batcher.model = model
+        startup["timings"]["model_load"] = time.perf_counter() - start
+        if warmup_runs > 0:
+            startup["timings"]["warmup_runs"] = await loop.run_in_executor(
+                torch_executor.executor, warm_up, model, device, warmup_runs, warmup_height, warmup_width)
+        startup["model_ready"] = True
+
+        # The process pool spawns its workers on demand; one concurrent job per worker starts them all
+        # and imports the VP pipeline in each
+        start = time.perf_counter()
+        image = np.random.default_rng(0).integers(0, 256, size=(240, 320, 3), dtype=np.uint8)
+        await asyncio.gather(*[vp_executor.run(compute_vanishing_points, image, 5.0, 100, 11, 7, 2.0)
+                               for _ in range(vp_workers)])
+        startup["timings"]["vp_workers"] = time.perf_counter() - start
+        startup["status"] = "ready"
+        job_runner.start()
+    except Exception as e:
+        startup["status"] = "failed"
+        startup["error"] = str(e)
+
+def model_not_ready_response():
+    error = startup["error"] if startup["status"] == "failed" else "model is loading"
+    return JSONResponse(content={"error": error}, status_code=503, headers={"Retry-After": str(retry_after)})
+
+# Detections of a large image from overlapping tiles, merged into image coordinates. Tiles go through
+# the batcher max_batch_size at a time and each output is compacted before the next group runs, so
+# peak memory depends on the tile size and batch size rather than on the image size.
+async def predict_tiles(image, tile_size, tile_overlap, compact_filter):
+    tiles = get_tiles(image.shape[0], image.shape[1], tile_size, tile_overlap)
+    outputs = []
+    for start in range(0, len(tiles), max_batch_size):
+        group = tiles[start:start + max_batch_size]
+        raw_outputs = await asyncio.gather(*[batcher.submit(image[y0:y1, x0:x1]) for x0, y0, x1, y1 in group])
+        outputs += await asyncio.gather(*[torch_executor.run(compact_output, output, *compact_filter)
+                                          for output in raw_outputs])
+        del raw_outputs
+    return await torch_executor.run(merge_tile_outputs, outputs, tiles, image.shape[0], image.shape[1])
+
+# Window segmentation for one upload: the compact output, the indices of the detections kept and
+# their contours, and the decoding scale. `decoded` is the (image, scale) pair from decode_image when
+# the caller already decoded the upload; it is only decoded here on a cache miss otherwise. With a
+# tile_size, images larger than one tile are segmented tile by tile (predict_tiles).
+async def get_detections(image_data, image_key, threshold, target_class_id, max_side, decoded=None, tile_size=None,
+                         tile_overlap=128):
+    # Tiles are merged after the score/class filter (duplicates below the threshold or of another class
+    # must not suppress anything), so tiled results are cached per filter
+    tile_filter = (threshold, target_class_id) if tile_size is not None else ()
+    key = make_key("predict", model_backend, model_path, image_key, max_side, tile_size, tile_overlap, *tile_filter)
+    cached = await result_cache.get_async(key)
+    if cached is not None:
+        output, scale = cached
+    else:
+        if decoded is None:
+            with metrics.stage("decode"):
+                decoded = await torch_executor.run(decode_image, image_data, max_side)
+        image, scale = decoded
+        metrics.observe(metrics.image_megapixels, image.shape[0] * image.shape[1] / scale ** 2 / 1e6)
+        # Every untiled detection is kept when caching so later threshold/class changes can reuse the entry
+        compact_filter = () if result_cache.enabled and not tile_filter else (threshold, target_class_id)
+        if tile_size is not None and max(image.shape[:2]) > tile_size:
+            with metrics.stage("tiled_inference"):
+                output = await predict_tiles(image, tile_size, tile_overlap, compact_filter)
+        else:
+            output = await batcher.submit(image)
+            with metrics.stage("mask_transfer"):
+                output = await torch_executor.run(compact_output, output, *compact_filter)
+        if result_cache.enabled:
+            await result_cache.put_async(key, (output, scale))
+    with metrics.stage("linearize"):
+        output, indices, contours = await torch_executor.run(linearize_detections, output, threshold,
+                                                             target_class_id, scale, linearize_pool)
+    metrics.observe(metrics.detection_count, len(indices))
+    return output, indices, contours, scale
+
+# Window segmentation for one upload as the JSON response of /predict/ (see get_detections)
+async def get_predictions(image_data, image_key, threshold, target_class_id, max_side, decoded=None, tile_size=None,
+                          tile_overlap=128, include_masks=False):
+    output, indices, contours, scale = await get_detections(image_data, image_key, threshold, target_class_id,
+                                                            max_side, decoded, tile_size, tile_overlap)
+    with metrics.stage("serialize"):
+        response = {"predictions": await torch_executor.run(format_predictions, output, indices, contours, scale,
+                                                            include_masks)}
+    if include_masks:
+        response["mask_scale"] = scale
+    return response
+
+# Downscale factors of the coarse-to-fine VP search, given as a comma-separated query value ("4,2").
+# The last factor is the resolution of the final estimate: "4,2,1" refines it at full resolution.
+def parse_pyramid(pyramid):
+    if not pyramid:
+        return None
+    try:
+        factors = tuple(sorted({int(factor) for factor in pyramid.split(",")}, reverse=True))
+    except ValueError:
+        factors = (0,)
+    if factors[-1] < 1:
+        raise ValueError("pyramid factors must be positive integers, e.g. 4,2")
+    return factors
+
+# reduce_lines arguments when the line set is reduced before RANSAC, None otherwise
+def line_reduction_options(reduce_lines, merge_angle, min_length_quantile, max_lines):
+    if not reduce_lines:
+        return None
+    return {"merge_angle": merge_angle, "min_length_quantile": min_length_quantile, "max_lines": max_lines}
+
+# Vanishing points for one upload, stopping each RANSAC pass early once `confidence` is reached.
+# Without `decoded` the worker decodes the upload bytes itself. `progress` and `cancel` are passed on
+# to compute_vanishing_points; a cached result sends no progress events.
+async def get_vanishing_points(image_data, image_key, max_side, sigma, iterations, line_len, line_gap, threshold,
+                               batched, confidence, min_iterations, decoded=None, pyramid=None, line_reduction=None,
+                               solver="sequential", progress=None, cancel=None):
+    key = make_key("vp", image_key, sigma, iterations, line_len, line_gap, threshold,
+                   batched, confidence, min_iterations, max_side, pyramid, solver,
+                   None if line_reduction is None else sorted(line_reduction.items()))
+    cached = await result_cache.get_async(key)
+    if cached is not None:
+        hypothesis_list, info = cached
+    else:
+        image, scale = decoded if decoded is not None else (image_data, 1.0)
+        hypothesis_list, info = await vp_executor.run(
+            compute_vanishing_points, image, sigma, iterations, line_len, line_gap, threshold,
+            batched=batched, confidence=confidence, min_iterations=min_iterations, image_key=image_key,
+            max_side=max_side, scale=scale, pyramid=pyramid, line_reduction=line_reduction, solver=solver,
+            workers=vp_solver_threads, progress=progress, cancel=cancel
+        )
+        await result_cache.put_async(key, (hypothesis_list, info))
+        # Stages ran in the worker, so their durations come back with the result
+        metrics.record_stages(info["timings"])
+        metrics.observe(metrics.line_count, info["lines"])
+        if decoded is None:
+            metrics.observe(metrics.image_megapixels, info["megapixels"])
+
+    # Prepare JSON response
+    vanishing_points = [
+        None if vp is None else {"x": vp[0], "y": vp[1]} for vp in hypothesis_list
+    ]
+
+    response = {
+        "vanishing_points": vanishing_points,
+        "iterations_used": info["iterations"],
+    }
+    if "levels" in info:
+        response["pyramid_levels"] = info["levels"]
+    if "reduced_lines" in info:
+        response["line_counts"] = {"hough": info["lines"], "reduced": info["reduced_lines"]}
+    return response
+
+# Asynchronous jobs: POST /jobs/ queues one job per uploaded image and answers at once with the job
+# IDs, and GET /jobs/{job_id} returns the job, with its result once done, optionally waiting for it.
+# The queue lives in SQLite under GLASSFINDER_JOB_DIR, so queued jobs survive a restart, and runs
+# once the model is ready on GLASSFINDER_JOB_WORKERS workers sharing the pools of the HTTP endpoints.
+# Finished jobs older than GLASSFINDER_JOB_RETENTION_HOURS are deleted at startup. A job submitted
+# again with the same image, task and parameters is answered with the existing job.
+PREDICT_JOB_PARAMS = ("threshold", "target_class_id", "max_side", "tile_size", "tile_overlap", "include_masks")
+VP_JOB_PARAMS = ("sigma", "iterations", "line_len", "line_gap", "angle_threshold", "batched", "confidence",
+                 "min_iterations", "max_side", "pyramid", "reduce_lines", "merge_angle", "min_length_quantile",
+                 "max_lines", "solver")
+JOB_TASKS = {
+    "predict": PREDICT_JOB_PARAMS,
+    "vanishing_points": VP_JOB_PARAMS,
+    "analyze": PREDICT_JOB_PARAMS + VP_JOB_PARAMS,
+}
+max_job_wait = float(os.environ.get("GLASSFINDER_JOB_MAX_WAIT", 60))
+
+# JSON result of one job: the response of /predict/, /detect-vanishing-points/ or /analyze/ for the
+# same parameters. Metrics are recorded under a per-task endpoint label, e.g. "job:analyze".
+async def run_job(task, image_data, params):
+    endpoint_token = metrics.current_endpoint.set(f"job:{task}")
+    tasks = []
+    try:
+        image_key = image_hash(image_data)
+        max_side = params["max_side"]
+        decoded = None
+        if task == "analyze":
+            with metrics.stage("decode"):
+                decoded = await torch_executor.run(decode_image, image_data, max_side)
+        if task != "vanishing_points":
+            tasks.append(asyncio.ensure_future(get_predictions(
+                image_data, image_key, params["threshold"], params["target_class_id"], max_side, decoded=decoded,
+                tile_size=params["tile_size"], tile_overlap=params["tile_overlap"],
+                include_masks=params["include_masks"])))
+        if task != "predict":
+            tasks.append(asyncio.ensure_future(get_vanishing_points(
+                image_data, image_key, max_side, params["sigma"], params["iterations"], params["line_len"],
+                params["line_gap"], params["angle_threshold"], params["batched"], params["confidence"],
+                params["min_iterations"], decoded=decoded, pyramid=parse_pyramid(params["pyramid"]),
+                line_reduction=line_reduction_options(params["reduce_lines"], params["merge_angle"],
+                                                      params["min_length_quantile"], params["max_lines"]),
+                solver=params["solver"])))
+        response = {}
+        for result in await asyncio.gather(*tasks):
+            response.update(result)
+        return dumps(response)
+    finally:
+        for job_task in tasks:
+            job_task.cancel()
+        metrics.current_endpoint.reset(endpoint_token)
+
+job_store = JobStore(os.environ.get("GLASSFINDER_JOB_DIR", "jobs"),
+                     retention_seconds=float(os.environ.get("GLASSFINDER_JOB_RETENTION_HOURS", 168)) * 3600,
+                     lease_seconds=float(os.environ.get("GLASSFINDER_JOB_LEASE_SECONDS", 60)),
+                     max_attempts=int(os.environ.get("GLASSFINDER_JOB_MAX_ATTEMPTS", 3)))
+job_runner = JobRunner(job_store, run_job, workers=int(os.environ.get("GLASSFINDER_JOB_WORKERS", 2)))
+
+def job_response(job):
+    response = {key: job[key] for key in ("id", "task", "status", "attempts", "created_at", "started_at",
+                                          "finished_at")}
+    if job["status"] == DONE:
+        response["result"] = loads(job["result"])
+    elif job["error"] is not None:
+        response["error"] = job["error"]
+    return response
+
+# Window segmentation of one upload. The response is JSON unless the client asks for packed typed
+# arrays (encoding.pack_predictions) with format=binary or an Accept header naming BINARY_MEDIA_TYPE.
+# include_masks adds each window's run-length encoded mask.
 @app.post("/predict/")
-async def predict(file: UploadFile = File(...), threshold: float = 0.5, target_class_id: int = 10):
+async def predict(request: Request, file: UploadFile = File(...), threshold: float = 0.5, target_class_id: int = 10,
+                  max_side: int = None, tile_size: int = None, tile_overlap: int = 128, format: str = None,
+                  include_masks: bool = False):
+    if not startup["model_ready"]:
+        return model_not_ready_response()
+    if max_side is not None and max_side <= 0:
+        return JSONResponse(content={"error": "max_side must be positive"}, status_code=400)
+    if tile_size is not None and tile_size < MIN_TILE_SIZE:
+        return JSONResponse(content={"error": f"tile_size must be at least {MIN_TILE_SIZE}"}, status_code=400)
+    if tile_size is not None and not 0 <= tile_overlap < tile_size:
+        return JSONResponse(content={"error": "tile_overlap must be in [0, tile_size)"}, status_code=400)
+    if format is None:
+        format = "binary" if BINARY_MEDIA_TYPE in request.headers.get("accept", "") else "json"
+    if format not in ("json", "binary"):
+        return JSONResponse(content={"error": "format must be json or binary"}, status_code=400)
     try:
-        image_data = await file.read()
-        results = predict_and_linearize(model, image_data, device, threshold, target_class_id)
+        async with predict_limiter:
+            with metrics.stage("upload"):
+                image_data = await file.read()
+            if max_side is None:
+                max_side = default_max_side
+            if format == "binary":
+                output, indices, contours, scale = await get_detections(
+                    image_data, image_hash(image_data), threshold, target_class_id, max_side, tile_size=tile_size,
+                    tile_overlap=tile_overlap)
+                with metrics.stage("serialize"):
+                    body = await torch_executor.run(pack_predictions, output, indices, contours, scale,
+                                                    include_masks)
+                return Response(content=body, media_type=BINARY_MEDIA_TYPE)
+            response = await get_predictions(image_data, image_hash(image_data), threshold, target_class_id,
+                                             max_side, tile_size=tile_size, tile_overlap=tile_overlap,
+                                             include_masks=include_masks)
 
         # Return results as JSON
-        return JSONResponse(content={"predictions": results})
+        return FastJSONResponse(content=response)
+    except Saturated as e:
+        return saturated_response(e)
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
+# With stream=true the response is NDJSON, or Server-Sent Events when the Accept header asks for
+# text/event-stream. It carries the progress events of compute_vanishing_points as the RANSAC passes
+# run ("hypothesis", then "vanishing_point" once a pass completes), then the usual response as a
+# "result" event (or an "error" event). A client that disconnects stops the worker at its next check.
 @app.post("/detect-vanishing-points/")
-async def detect_vanishing_points(file: UploadFile = File(...),
+async def detect_vanishing_points(request: Request,
+                                   file: UploadFile = File(...),
                                    sigma: float = 5.0,
                                    iterations: int = 3000,
                                    line_len: int = 11,
                                    line_gap: int = 7,
-                                   threshold: float = 2.0):
+                                   threshold: float = 2.0,
+                                   batched: bool = True,
+                                   confidence: float = None,
+                                   min_iterations: int = 100,
+                                   max_iterations: int = None,
+                                   max_side: int = None,
+                                   pyramid: str = None,
+                                   reduce_lines: bool = False,
+                                   merge_angle: float = 1.0,
+                                   min_length_quantile: float = 0.25,
+                                   max_lines: int = 500,
+                                   solver: str = "sequential",
+                                   stream: bool = False):
+    if solver not in SOLVERS:
+        return JSONResponse(content={"error": f"solver must be one of {', '.join(SOLVERS)}"}, status_code=400)
+    if confidence is not None and not 0 < confidence < 1:
+        return JSONResponse(content={"error": "confidence must be in (0, 1)"}, status_code=400)
+    if max_side is not None and max_side <= 0:
+        return JSONResponse(content={"error": "max_side must be positive"}, status_code=400)
     try:
-        # Save uploaded file temporarily
-        temp_file = tempfile.NamedTemporaryFile(delete=False)
-        temp_file.write(await file.read())
-        temp_file.close()
-
-        # Process image
-        inlier_lines_list, hypothesis_list, image, edges, lines = get_vp_inliers(
-            temp_file.name, sigma, iterations, line_len, line_gap, threshold
-        )
+        async with AsyncExitStack() as stack:
+            await stack.enter_async_context(vp_limiter)
+            with metrics.stage("upload"):
+                image_data = await file.read()
+            if max_iterations is not None:
+                iterations = max_iterations
+            if max_side is None:
+                max_side = default_max_side
+            job = functools.partial(get_vanishing_points, image_data, image_hash(image_data), max_side, sigma,
+                                    iterations, line_len, line_gap, threshold, batched, confidence, min_iterations,
+                                    pyramid=parse_pyramid(pyramid),
+                                    line_reduction=line_reduction_options(reduce_lines, merge_angle,
+                                                                          min_length_quantile, max_lines),
+                                    solver=solver)
+            if not stream:
+                return FastJSONResponse(content=await job())
+            events, cancel = await make_progress_channel()
+            task = asyncio.ensure_future(job(progress=events.put, cancel=cancel))
+            # The stream now owns the endpoint slot and releases it once it ends
+            limits = stack.pop_all()
+
+    except Saturated as e:
+        return saturated_response(e)
+    except ValueError as e:
+        # Invalid parameters, e.g. pyramid factors that do not fit the image
+        return JSONResponse(content={"error": str(e)}, status_code=400)
+    except Exception as e:
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+
+    sse = "text/event-stream" in request.headers.get("accept", "")
 
-        # Save visualizations
-        colors = ['r', 'g', 'b']
+    def format_event(event):
+        if sse:
+            return b"event: " + event["event"].encode() + b"\ndata: " + dumps(event) + b"\n\n"
+        return dumps(event) + b"\n"
 
-        # Prepare JSON response
-        vanishing_points = [
-            {"x": vp[0], "y": vp[1]} for vp in hypothesis_list
-        ]
+    def drain():
+        while True:
+            try:
+                yield format_event(events.get_nowait())
+            except queue.Empty:
+                return
 
-        response = {
-            "vanishing_points": vanishing_points,
-        }
+    async def stream_events():
+        try:
+            while not task.done():
+                await asyncio.wait({task}, timeout=stream_poll_interval)
+                for line in drain():
+                    yield line
+                if not task.done() and await request.is_disconnected():
+                    return
+            for line in drain():
+                yield line
+            try:
+                result = {"event": "result", **task.result()}
+            except Saturated as e:
+                result = {"event": "error", "error": str(e), "retry_after": e.retry_after}
+            except Exception as e:
+                result = {"event": "error", "error": str(e)}
+            yield format_event(result)
+        finally:
+            if not task.done():
+                # Stop the worker instead of finishing a search nobody reads; the task then ends with
+                # Cancelled, which is retrieved here so it is not reported as unhandled
+                cancel.set()
+                task.add_done_callback(lambda task: task.cancelled() or task.exception())
+            await limits.aclose()
 
-        return JSONResponse(content=response)
+    return StreamingResponse(stream_events(), media_type="text/event-stream" if sse else "application/x-ndjson")
 
+# Window segmentation and vanishing points from a single upload. The image is decoded once and both
+# halves run concurrently; `threshold` is the detection score threshold as in /predict/ and
+# `angle_threshold` the RANSAC threshold of /detect-vanishing-points/. With stream=true the response
+# is NDJSON with one line per half, sent as soon as that half completes.
+@app.post("/analyze/")
+async def analyze(file: UploadFile = File(...),
+                  threshold: float = 0.5,
+                  target_class_id: int = 10,
+                  sigma: float = 5.0,
+                  iterations: int = 3000,
+                  line_len: int = 11,
+                  line_gap: int = 7,
+                  angle_threshold: float = 2.0,
+                  batched: bool = True,
+                  confidence: float = None,
+                  min_iterations: int = 100,
+                  max_iterations: int = None,
+                  max_side: int = None,
+                  pyramid: str = None,
+                  reduce_lines: bool = False,
+                  merge_angle: float = 1.0,
+                  min_length_quantile: float = 0.25,
+                  max_lines: int = 500,
+                  solver: str = "sequential",
+                  stream: bool = False):
+    if not startup["model_ready"]:
+        return model_not_ready_response()
+    if solver not in SOLVERS:
+        return JSONResponse(content={"error": f"solver must be one of {', '.join(SOLVERS)}"}, status_code=400)
+    if confidence is not None and not 0 < confidence < 1:
+        return JSONResponse(content={"error": "confidence must be in (0, 1)"}, status_code=400)
+    if max_side is not None and max_side <= 0:
+        return JSONResponse(content={"error": "max_side must be positive"}, status_code=400)
+    try:
+        async with AsyncExitStack() as stack:
+            await stack.enter_async_context(predict_limiter)
+            await stack.enter_async_context(vp_limiter)
+            with metrics.stage("upload"):
+                image_data = await file.read()
+            if max_iterations is not None:
+                iterations = max_iterations
+            if max_side is None:
+                max_side = default_max_side
+            pyramid = parse_pyramid(pyramid)
+            image_key = image_hash(image_data)
+            with metrics.stage("decode"):
+                decoded = await torch_executor.run(decode_image, image_data, max_side)
+            tasks = [
+                asyncio.ensure_future(get_predictions(image_data, image_key, threshold, target_class_id, max_side,
+                                                      decoded=decoded)),
+                asyncio.ensure_future(get_vanishing_points(image_data, image_key, max_side, sigma, iterations,
+                                                           line_len, line_gap, angle_threshold, batched, confidence,
+                                                           min_iterations, decoded=decoded,
+                                                           pyramid=pyramid,
+                                                           line_reduction=line_reduction_options(
+                                                               reduce_lines, merge_angle, min_length_quantile,
+                                                               max_lines),
+                                                           solver=solver)),
+            ]
+            if stream:
+                # The stream now owns the endpoint slots and releases them once it ends
+                limits = stack.pop_all()
+            else:
+                try:
+                    response = {}
+                    for result in await asyncio.gather(*tasks):
+                        response.update(result)
+                finally:
+                    for task in tasks:
+                        task.cancel()
+                return FastJSONResponse(content=response)
+    except Saturated as e:
+        return saturated_response(e)
+    except ValueError as e:
+        # Invalid parameters, e.g. pyramid factors that do not fit the image
+        return JSONResponse(content={"error": str(e)}, status_code=400)
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
+    async def stream_results():
+        try:
+            for task in asyncio.as_completed(tasks):
+                try:
+                    result = await task
+                except Saturated as e:
+                    result = {"error": str(e), "retry_after": e.retry_after}
+                except Exception as e:
+                    result = {"error": str(e)}
+                yield dumps(result) + b"\n"
+        finally:
+            for task in tasks:
+                task.cancel()
+            await limits.aclose()
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+# Queues `task` ("predict", "vanishing_points" or "analyze") for every uploaded file, with the query
+# parameters of the matching endpoint (angle_threshold is the RANSAC threshold, as in /analyze/).
+@app.post("/jobs/")
+async def submit_jobs(files: List[UploadFile] = File(...),
+                      task: str = "analyze",
+                      threshold: float = 0.5,
+                      target_class_id: int = 10,
+                      max_side: int = None,
+                      tile_size: int = None,
+                      tile_overlap: int = 128,
+                      include_masks: bool = False,
+                      sigma: float = 5.0,
+                      iterations: int = 3000,
+                      line_len: int = 11,
+                      line_gap: int = 7,
+                      angle_threshold: float = 2.0,
+                      batched: bool = True,
+                      confidence: float = None,
+                      min_iterations: int = 100,
+                      max_iterations: int = None,
+                      pyramid: str = None,
+                      reduce_lines: bool = False,
+                      merge_angle: float = 1.0,
+                      min_length_quantile: float = 0.25,
+                      max_lines: int = 500,
+                      solver: str = "sequential"):
+    if task not in JOB_TASKS:
+        return JSONResponse(content={"error": f"task must be one of {', '.join(JOB_TASKS)}"}, status_code=400)
+    if solver not in SOLVERS:
+        return JSONResponse(content={"error": f"solver must be one of {', '.join(SOLVERS)}"}, status_code=400)
+    if confidence is not None and not 0 < confidence < 1:
+        return JSONResponse(content={"error": "confidence must be in (0, 1)"}, status_code=400)
+    if max_side is not None and max_side <= 0:
+        return JSONResponse(content={"error": "max_side must be positive"}, status_code=400)
+    if tile_size is not None and tile_size < MIN_TILE_SIZE:
+        return JSONResponse(content={"error": f"tile_size must be at least {MIN_TILE_SIZE}"}, status_code=400)
+    if tile_size is not None and not 0 <= tile_overlap < tile_size:
+        return JSONResponse(content={"error": "tile_overlap must be in [0, tile_size)"}, status_code=400)
+    if max_iterations is not None:
+        iterations = max_iterations
+    if max_side is None:
+        max_side = default_max_side
+    try:
+        parse_pyramid(pyramid)
+    except ValueError as e:
+        return JSONResponse(content={"error": str(e)}, status_code=400)
+    values = {
+        "threshold": threshold, "target_class_id": target_class_id, "max_side": max_side, "tile_size": tile_size,
+        "tile_overlap": tile_overlap, "include_masks": include_masks, "sigma": sigma, "iterations": iterations,
+        "line_len": line_len, "line_gap": line_gap, "angle_threshold": angle_threshold, "batched": batched,
+        "confidence": confidence, "min_iterations": min_iterations, "pyramid": pyramid,
+        "reduce_lines": reduce_lines, "merge_angle": merge_angle, "min_length_quantile": min_length_quantile,
+        "max_lines": max_lines, "solver": solver,
+    }
+    # Only the parameters the task uses, so they alone decide whether a submission is a duplicate
+    params = {name: values[name] for name in JOB_TASKS[task]}
+    jobs = []
+    try:
+        for file in files:
+            with metrics.stage("upload"):
+                image_data = await file.read()
+            job_id, deduplicated, status = await job_runner.submit(task, params, image_hash(image_data), image_data)
+            jobs.append({"id": job_id, "filename": file.filename, "status": status, "deduplicated": deduplicated})
+    except Exception as e:
+        return JSONResponse(content={"error": str(e), "jobs": jobs}, status_code=500)
+    return JSONResponse(content={"jobs": jobs}, status_code=202)
+
+# Status of one job, with its result once done. With `wait` (seconds, at most GLASSFINDER_JOB_MAX_WAIT)
+# the request is held until the job finishes or the wait expires.
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, wait: float = 0):
+    job = await job_runner.wait(job_id, min(wait, max_job_wait))
+    if job is None:
+        return JSONResponse(content={"error": "unknown job"}, status_code=404)
+    return FastJSONResponse(content=job_response(job))
+
+# Readiness probe for the load balancer: 503 until startup has completed
+@app.get("/health")
+async def health():
+    return JSONResponse(content=startup, status_code=200 if startup["status"] == "ready" else 503)
+
+# Prometheus scrape endpoint
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,228 @@
+# Headless batch processing of whole image directories. Images are decoded by a prefetching thread
+# pool, segmented in batches by Mask R-CNN while a process pool detects vanishing points, and one
+# JSON Lines record per image is appended to the output as soon as it is complete. Re-running the
+# same command skips images already recorded, so an interrupted run resumes where it stopped.
+#
+#   python batch_process.py /data/facades --output results.jsonl --batch-size 8
+#   python batch_process.py "/data/**/*.jpg" --output results.jsonl --no-vp
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from executors import make_executor
+from imaging import decode_image
+from inference import compact_output, linearize_predictions, load_backend, run_model
+from vp_detection import SOLVERS, compute_vanishing_points
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+
+# Every image under the given directories or matching the given glob patterns, in a stable order
+def iter_image_paths(inputs):
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            paths = (os.path.join(root, name) for root, _, names in os.walk(pattern) for name in names)
+        else:
+            paths = glob.glob(pattern, recursive=True)
+        for path in sorted(paths):
+            if path.lower().endswith(IMAGE_EXTENSIONS):
+                yield os.path.abspath(path)
+
+# Images already recorded by a previous run. A truncated last line from a crash is ignored, so
+# that image is processed again, as are failed images with retry_errors.
+def load_done(output_path, retry_errors=False):
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if "image" in record and not (retry_errors and "error" in record):
+                done.add(record["image"])
+    return done
+
+def decode_file(path, max_side):
+    try:
+        with open(path, "rb") as f:
+            image, scale = decode_image(f.read(), max_side)
+        return path, image, scale, None
+    except Exception as e:
+        return path, None, 1.0, str(e)
+
+# Apply fn to items in a thread pool, keeping at most depth results in flight ahead of the consumer
+def prefetch(executor, fn, items, depth):
+    in_flight = deque()
+    for item in items:
+        in_flight.append(executor.submit(fn, item))
+        if len(in_flight) >= depth:
+            yield in_flight.popleft().result()
+    while in_flight:
+        yield in_flight.popleft().result()
+
+def batched(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class ResultWriter:
+    # Appends one JSON record per line and flushes it, so a crash loses at most the record being written
+    def __init__(self, output_path):
+        self.file = open(output_path, "a+")
+        self.file.seek(0, os.SEEK_END)
+        if self.file.tell() > 0:
+            self.file.seek(self.file.tell() - 1)
+            if self.file.read(1) != "\n":
+                self.file.write("\n")  # Do not glue the next record to a truncated line
+        self.count = 0
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Segment windows and detect vanishing points for many images")
+    parser.add_argument("inputs", nargs="+", help="image directories or glob patterns")
+    parser.add_argument("--output", default="results.jsonl")
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--prefetch", type=int, default=16, help="images decoded ahead of the model")
+    parser.add_argument("--decode-workers", type=int, default=4)
+    parser.add_argument("--vp-workers", type=int, default=os.cpu_count())
+    parser.add_argument("--linearize-workers", type=int, default=4)
+    parser.add_argument("--max-side", type=int, default=None)
+    parser.add_argument("--backend", default="eager", choices=["eager", "torchscript", "onnx"])
+    parser.add_argument("--model-path", default="models/best_model.pth")
+    parser.add_argument("--num-classes", type=int, default=12)
+    parser.add_argument("--threshold", type=float, default=0.5)
+    parser.add_argument("--target-class-id", type=int, default=10)
+    parser.add_argument("--retry-errors", action="store_true", help="process again images that failed before")
+    parser.add_argument("--no-predict", action="store_true", help="skip window segmentation")
+    parser.add_argument("--no-vp", action="store_true", help="skip vanishing point detection")
+    parser.add_argument("--sigma", type=float, default=5.0)
+    parser.add_argument("--iterations", type=int, default=3000)
+    parser.add_argument("--line-len", type=int, default=11)
+    parser.add_argument("--line-gap", type=int, default=7)
+    parser.add_argument("--angle-threshold", type=float, default=2.0)
+    parser.add_argument("--confidence", type=float, default=None)
+    parser.add_argument("--min-iterations", type=int, default=100)
+    parser.add_argument("--pyramid", type=int, nargs="+", default=None,
+                        help="downscale factors of the coarse-to-fine vanishing point search, e.g. 4 2 "
+                             "(the last one is the resolution of the result: add 1 to refine at full resolution)")
+    parser.add_argument("--reduce-lines", action="store_true",
+                        help="merge collinear segments, drop short ones and weight RANSAC votes by length")
+    parser.add_argument("--min-length-quantile", type=float, default=0.25)
+    parser.add_argument("--max-lines", type=int, default=500)
+    parser.add_argument("--solver", default="sequential", choices=SOLVERS,
+                        help="joint scores one shared hypothesis pool for all three vanishing points")
+    parser.add_argument("--solver-threads", type=int, default=1, help="threads of the joint solver per VP worker")
+    args = parser.parse_args()
+    if args.confidence is not None and not 0 < args.confidence < 1:
+        parser.error("--confidence must be in (0, 1)")
+    if args.max_side is not None and args.max_side <= 0:
+        parser.error("--max-side must be positive")
+
+    done = load_done(args.output, args.retry_errors)
+    paths = [path for path in iter_image_paths(args.inputs) if path not in done]
+    print(f"{len(paths)} images to process, {len(done)} already in {args.output}", file=sys.stderr)
+    if not paths:
+        return
+
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    model = None if args.no_predict else load_backend(args.backend, args.model_path, args.num_classes, device)
+    decode_pool = ThreadPoolExecutor(max_workers=args.decode_workers)
+    linearize_pool = ThreadPoolExecutor(max_workers=args.linearize_workers)
+    vp_pool = None if args.no_vp else make_executor("process", args.vp_workers)
+    line_reduction = None
+    if args.reduce_lines:
+        line_reduction = {"min_length_quantile": args.min_length_quantile, "max_lines": args.max_lines}
+    writer = ResultWriter(args.output)
+
+    # Records wait here until their vanishing points are ready; their number is bounded so decoded
+    # images do not pile up when the VP stage is slower than the model
+    pending = deque()
+    max_pending = 4 * (args.vp_workers or 1) + args.batch_size
+
+    # Write completed records in input order, waiting on the oldest while more than max_waiting are pending
+    def write_ready(max_waiting):
+        while pending:
+            record, vp_future = pending[0]
+            if vp_future is not None and not vp_future.done() and len(pending) <= max_waiting:
+                break
+            pending.popleft()
+            if vp_future is not None:
+                try:
+                    hypothesis_list, info = vp_future.result()
+                    # A pass that found no vanishing point gives null, as in the API
+                    record["vanishing_points"] = [None if vp is None else {"x": float(vp[0]), "y": float(vp[1])}
+                                                  for vp in hypothesis_list]
+                    record["iterations_used"] = info["iterations"]
+                except Exception as e:
+                    record["error"] = str(e)
+            writer.write(record)
+
+    start = time.perf_counter()
+    try:
+        decoded = prefetch(decode_pool, lambda path: decode_file(path, args.max_side), paths, args.prefetch)
+        for batch in batched(decoded, args.batch_size):
+            valid = []
+            for path, image, scale, error in batch:
+                if error is not None:
+                    pending.append(({"image": path, "error": error}, None))
+                    continue
+                record = {"image": path, "height": round(image.shape[0] / scale), "width": round(image.shape[1] / scale)}
+                vp_future = None
+                if vp_pool is not None:
+                    vp_future = vp_pool.submit(
+                        compute_vanishing_points, image, args.sigma, args.iterations, args.line_len, args.line_gap,
+                        args.angle_threshold, scale=scale, confidence=args.confidence,
+                        min_iterations=args.min_iterations, pyramid=args.pyramid,
+                        line_reduction=line_reduction, solver=args.solver, workers=args.solver_threads)
+                valid.append((record, image, scale))
+                pending.append((record, vp_future))
+
+            if model is not None and valid:
+                try:
+                    outputs = run_model(model, [image for _, image, _ in valid], device)
+                    for (record, _, scale), output in zip(valid, outputs):
+                        output = compact_output(output, args.threshold, args.target_class_id)
+                        record["predictions"] = linearize_predictions(output, args.threshold, args.target_class_id,
+                                                                      scale, linearize_pool)
+                except Exception as e:
+                    for record, _, _ in valid:
+                        record["error"] = str(e)
+
+            write_ready(max_pending)
+            elapsed = time.perf_counter() - start
+            print(f"\r{writer.count}/{len(paths)} images, {writer.count / elapsed:.2f} images/s",
+                  end="", file=sys.stderr)
+        write_ready(0)
+    finally:
+        writer.close()
+        decode_pool.shutdown(cancel_futures=True)
+        linearize_pool.shutdown()
+        if vp_pool is not None:
+            vp_pool.shutdown(cancel_futures=True)
+    print(f"\nWrote {writer.count} records to {args.output} in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import asyncio
+import time
+
+import metrics
+from executors import Saturated
+from inference import run_model
+
+
+class InferenceBatcher:
+    # Groups concurrent requests into a single Mask R-CNN forward pass. Requests wait at most
+    # max_wait_ms for companions and a batch never holds more than max_batch_size images;
+    # once max_queue_size images are waiting new submissions are rejected with Saturated.
+    def __init__(self, model, device, max_batch_size=4, max_wait_ms=10, executor=None, max_queue_size=None,
+                 retry_after=1):
+        self.model = model
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.executor = executor
+        self.max_queue_size = max_queue_size
+        self.retry_after = retry_after
+        self.queue = None
+        self.task = None
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    # Queue one decoded HWC uint8 RGB array (imaging.decode_image, or a tile view of one) and wait for
+    # its raw output dict, in the pixels of that array: callers map it back with their decoding scale.
+    # A CHW float tensor is accepted too (see inference.run_model).
+    async def submit(self, image):
+        if self.max_queue_size is not None and self.queue.qsize() >= self.max_queue_size:
+            raise Saturated("inference queue", self.retry_after)
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((image, future, time.perf_counter()))
+        output, queue_wait, forward_time = await future
+        # Recorded here, back in the request's context, so they reach its Server-Timing header too
+        if metrics.enabled:
+            metrics.queue_wait_seconds.observe(queue_wait, "inference batch")
+        metrics.record_stage("inference_queue", queue_wait)
+        metrics.record_stage("model_forward", forward_time)
+        return output
+
+    async def _next_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        # Requests whose client went away no longer need a result
+        return [item for item in batch if not item[1].cancelled()]
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            if not batch:
+                continue
+            images = [image for image, _, _ in batch]
+            start = time.perf_counter()
+            if metrics.enabled:
+                metrics.batch_size.observe(len(batch))
+            try:
+                # The forward pass runs off the event loop so other requests keep being accepted
+                outputs = await loop.run_in_executor(self.executor, run_model, self.model, images, self.device)
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            forward_time = time.perf_counter() - start
+            for (_, future, queued), output in zip(batch, outputs):
+                if not future.done():
+                    future.set_result((output, start - queued, forward_time))
@@ -0,0 +1,110 @@
+# Compares the original per-detection mask post-processing with compact_output + linearize_predictions
+# on a synthetic model output with many detections.
+#
+#   python benchmarks/bench_linearize.py --detections 100 --height 768 --width 1024
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from inference import compact_output, linearize_predictions
+
+
+# Fake Mask R-CNN output: random quadrilateral masks, half of them scored below the threshold and
+# some of another class
+def make_output(detections, height, width, device, seed=0):
+    rng = np.random.default_rng(seed)
+    masks = np.zeros((detections, 1, height, width), dtype=np.float32)
+    boxes = np.zeros((detections, 4), dtype=np.float32)
+    for i in range(detections):
+        w, h = rng.integers(10, width // 6), rng.integers(10, height // 6)
+        x, y = rng.integers(0, width - w), rng.integers(0, height - h)
+        jitter = rng.integers(0, 4, size=(4, 2)) * [[1, 1], [-1, 1], [-1, -1], [1, -1]]
+        quad = np.array([[x, y], [x + w, y], [x + w, y + h], [x, y + h]]) + jitter
+        cv2.fillPoly(masks[i, 0], [quad.astype(np.int32)], 0.9)
+        boxes[i] = [x, y, x + w, y + h]
+    labels = np.where(rng.random(detections) < 0.8, 10, 3)
+    scores = np.sort(rng.random(detections))[::-1].copy()
+    return {
+        'boxes': torch.from_numpy(boxes).to(device),
+        'labels': torch.from_numpy(labels).to(device),
+        'scores': torch.from_numpy(scores.astype(np.float32)).to(device),
+        'masks': torch.from_numpy(masks).to(device),
+    }
+
+# The post-processing loop predict_and_linearize used before compact_output
+def baseline(output, threshold, target_class_id):
+    results = []
+    boxes = output['boxes'].cpu().detach().numpy()
+    labels = output['labels'].cpu().detach().numpy()
+    scores = output['scores'].cpu().detach().numpy()
+    masks = output['masks'].cpu().detach().numpy()
+    for i, score in enumerate(scores):
+        if score >= threshold and labels[i] == target_class_id:
+            mask = masks[i][0] > 0.5
+            contours, _ = cv2.findContours(mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            linearized_contours = []
+            valid_prediction = True
+            for contour in contours:
+                epsilon = 0.04 * cv2.arcLength(contour, True)
+                approx = cv2.approxPolyDP(contour, epsilon, True)
+                if len(approx) != 4:
+                    valid_prediction = False
+                    break
+                linearized_contours.append(approx.reshape(-1, 2).tolist())
+            if not valid_prediction:
+                continue
+            results.append({
+                "class_id": int(labels[i]),
+                "score": float(score),
+                "bounding_box": boxes[i].astype(int).tolist(),
+                "linearized_contours": linearized_contours
+            })
+    return results
+
+def best_time(fn, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--detections", type=int, default=100)
+    parser.add_argument("--height", type=int, default=768)
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--threshold", type=float, default=0.5)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    output = make_output(args.detections, args.height, args.width, torch.device(args.device))
+    executor = ThreadPoolExecutor(max_workers=args.workers)
+    baseline_time, expected = best_time(lambda: baseline(output, args.threshold, 10), args.repeats)
+    serial_time, serial = best_time(
+        lambda: linearize_predictions(compact_output(output, args.threshold, 10), args.threshold, 10),
+        args.repeats)
+    parallel_time, parallel = best_time(
+        lambda: linearize_predictions(compact_output(output, args.threshold, 10), args.threshold, 10,
+                                      executor=executor),
+        args.repeats)
+    executor.shutdown()
+
+    print(f"{args.detections} detections on {args.width}x{args.height} ({args.device}), "
+          f"{len(expected)} kept, best of {args.repeats}")
+    print(f"  baseline            {baseline_time * 1000:8.1f} ms")
+    print(f"  compact + serial    {serial_time * 1000:8.1f} ms  x{baseline_time / serial_time:.1f}")
+    print(f"  compact + {args.workers} workers {parallel_time * 1000:8.1f} ms  x{baseline_time / parallel_time:.1f}")
+    print(f"  identical results   {serial == expected and parallel == expected}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+# Checks the line-set reduction applied before RANSAC (reduce_lines) on the sample images and a
+# synthetic facade: reports the line counts before and after, the RANSAC time, and the error of the
+# vanishing points found from the raw and from the reduced lines. The reference is the analytic VPs
+# of the synthetic facade, and for photos the two dominant VPs of a long RANSAC search over the raw
+# lines (the third one is too unstable between seeds to serve as a reference). Both runs share the
+# same Hough lines and seeds. VPs are compared as 3D directions (focal length = image diagonal) so
+# points near infinity are measured by angle rather than by pixel distance. Exits with status 1
+# when the median error with reduced lines exceeds --tolerance degrees.
+#
+#   python benchmarks/check_line_reduction.py --seeds 5 --tolerance 2
+import argparse
+import glob
+import os
+import sys
+
+import numpy as np
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+from imaging import decode_image
+from run_benchmarks import IMAGE_EXTENSIONS, SAMPLE_IMAGES, make_synthetic_facade
+from vp_detection import StageCache, get_vp_inliers
+
+def load_images(directory, synthetic_sizes):
+    images = []
+    for path in sorted(glob.glob(os.path.join(directory, "*"))):
+        if path.lower().endswith(IMAGE_EXTENSIONS):
+            with open(path, "rb") as f:
+                images.append((os.path.basename(path), decode_image(f.read())[0], None))
+    for width, height in synthetic_sizes:
+        images.append((f"synthetic_{width}x{height}", decode_image(make_synthetic_facade(width, height, 0))[0],
+                       synthetic_vanishing_points(width, height)))
+    return images
+
+def vp_direction(vp, image):
+    height, width = image.shape[:2]
+    direction = np.array([vp[0] - width / 2, vp[1] - height / 2, np.hypot(width, height)])
+    return direction / np.linalg.norm(direction)
+
+def vp_deviation(reference, candidate, image):
+    # Angle between each reference VP and the closest candidate VP, in degrees
+    candidate = np.array([vp_direction(vp, image) for vp in candidate if vp is not None])
+    return [float(np.degrees(np.arccos(min(1.0, np.abs(candidate @ vp_direction(vp, image)).max()))))
+            for vp in reference if vp is not None]
+
+def synthetic_vanishing_points(width, height):
+    # make_synthetic_facade draws window edges along the facade's top and bottom edges, which meet at
+    # the horizontal VP, and vertical edges, whose VP is at infinity
+    top = np.cross([0.1 * width, 0.15 * height, 1], [0.9 * width, 0.05 * height, 1])
+    bottom = np.cross([0.1 * width, 0.85 * height, 1], [0.9 * width, 0.95 * height, 1])
+    horizontal = np.cross(top, bottom)
+    return [horizontal / horizontal[-1], np.array([width / 2, 1e12, 1.0])]
+
+def run(image, key, cache, args, seed, line_reduction, iterations=None):
+    np.random.seed(seed)
+    info = {}
+    _, hypothesis_list, _, _, _ = get_vp_inliers(
+        image, args.sigma, iterations or args.iterations, args.line_len, args.line_gap, args.angle_threshold, info=info,
+        stage_cache=cache, image_key=key, line_reduction=line_reduction)
+    ransac_time = sum(value for name, value in info["timings"].items()
+                      if name.startswith("ransac") or name == "line_reduction")
+    return hypothesis_list, info, ransac_time
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--images", default=SAMPLE_IMAGES)
+    parser.add_argument("--synthetic", action="store_true", help="also check synthetic facades")
+    parser.add_argument("--seeds", type=int, default=5)
+    parser.add_argument("--tolerance", type=float, default=2.0, help="allowed median VP deviation in degrees")
+    parser.add_argument("--merge-angle", type=float, default=1.0)
+    parser.add_argument("--merge-distance", type=float, default=2.0)
+    parser.add_argument("--min-length-quantile", type=float, default=0.25)
+    parser.add_argument("--max-lines", type=int, default=500)
+    parser.add_argument("--sigma", type=float, default=5.0)
+    parser.add_argument("--iterations", type=int, default=3000)
+    parser.add_argument("--reference-iterations", type=int, default=20000,
+                        help="RANSAC iterations of the reference search on images without ground truth")
+    parser.add_argument("--line-len", type=int, default=11)
+    parser.add_argument("--line-gap", type=int, default=7)
+    parser.add_argument("--angle-threshold", type=float, default=2.0)
+    args = parser.parse_args()
+
+    line_reduction = {"merge_angle": args.merge_angle, "merge_distance": args.merge_distance,
+                      "min_length_quantile": args.min_length_quantile, "max_lines": args.max_lines}
+    synthetic_sizes = [(1280, 960)] if args.synthetic else []
+    raw_deviations, reduced_deviations = [], []
+    print(f"{'image':<32} {'lines':>6} {'reduced':>8} {'raw ms':>8} {'reduced ms':>11} {'raw err':>8} {'reduced err':>12}")
+    for name, image, reference in load_images(args.images, synthetic_sizes):
+        # One cache entry per image keeps the Hough lines identical across every run below
+        cache = StageCache(max_images=1)
+        if reference is None:
+            # Without ground truth, the two dominant VPs of a long search over the raw lines
+            reference = run(image, name, cache, args, 0, None, args.reference_iterations)[0][:2]
+        image_raw, image_reduced, raw_times, reduced_times = [], [], [], []
+        for seed in range(1, args.seeds + 1):
+            raw, info, raw_time = run(image, name, cache, args, seed, None)
+            reduced, reduced_info, reduced_time = run(image, name, cache, args, seed, line_reduction)
+            image_raw += vp_deviation(reference, raw, image)
+            image_reduced += vp_deviation(reference, reduced, image)
+            raw_times.append(raw_time)
+            reduced_times.append(reduced_time)
+        raw_deviations += image_raw
+        reduced_deviations += image_reduced
+        print(f"{name[:32]:<32} {info['lines']:>6} {reduced_info['reduced_lines']:>8} "
+              f"{np.median(raw_times) * 1000:>8.1f} {np.median(reduced_times) * 1000:>11.1f} "
+              f"{np.median(image_raw):>7.2f}° {np.median(image_reduced):>11.2f}°")
+
+    median = np.median(reduced_deviations)
+    print(f"median VP error: raw lines {np.median(raw_deviations):.2f}°, reduced lines {median:.2f}°, "
+          f"tolerance {args.tolerance}°")
+    if median > args.tolerance:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+# Times each stage of the segmentation and vanishing point pipelines over the sample images in
+# maskrcnn/images/ and synthetic facades at several resolutions, and saves the latency percentiles
+# to a JSON file that later runs can be compared against. Random seeds are fixed, so RANSAC
+# timings and the recorded outputs are reproducible between runs.
+#
+#   python benchmarks/run_benchmarks.py --output bench.json
+#   python benchmarks/run_benchmarks.py --output bench_new.json --compare bench.json
+import argparse
+import glob
+import json
+import os
+import platform
+import sys
+import time
+
+import cv2
+import numpy as np
+import torch
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+from imaging import decode_image
+from inference import compact_output, image_to_tensor, linearize_predictions, load_backend
+from vp_detection import (SOLVERS, get_canny_edges, get_grayscale, get_hough_lines, run_line_ransac_batched,
+                          run_multi_vp_ransac)
+
+SAMPLE_IMAGES = os.path.join(BACKEND_DIR, "..", "..", "maskrcnn", "images")
+SYNTHETIC_SIZES = [(640, 480), (1280, 960), (2560, 1920)]
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+
+# JPEG of a facade seen in perspective: a grid of windows converging towards two vanishing points
+def make_synthetic_facade(width, height, seed):
+    rng = np.random.default_rng(seed)
+    image = np.full((height, width, 3), 190, dtype=np.uint8)
+    image += rng.integers(0, 20, size=image.shape, dtype=np.uint8)
+    top_left, top_right = np.array([0.1, 0.15]), np.array([0.9, 0.05])
+    bottom_left, bottom_right = np.array([0.1, 0.85]), np.array([0.9, 0.95])
+
+    def facade_point(u, v):
+        top = top_left + (top_right - top_left) * u
+        bottom = bottom_left + (bottom_right - bottom_left) * u
+        return (top + (bottom - top) * v) * [width, height]
+
+    for row in range(6):
+        for col in range(8):
+            u0, v0 = (col + 0.25) / 8, (row + 0.2) / 6
+            u1, v1 = (col + 0.75) / 8, (row + 0.8) / 6
+            quad = np.array([facade_point(u0, v0), facade_point(u1, v0), facade_point(u1, v1), facade_point(u0, v1)])
+            cv2.fillPoly(image, [quad.astype(np.int32)], (60, 80, 100))
+            cv2.polylines(image, [quad.astype(np.int32)], True, (240, 240, 240), max(1, width // 400))
+    _, encoded = cv2.imencode(".jpg", image)
+    return encoded.tobytes()
+
+def load_inputs(image_dir, seed):
+    inputs = []
+    for path in sorted(glob.glob(os.path.join(image_dir, "*"))):
+        if path.lower().endswith(IMAGE_EXTENSIONS):
+            with open(path, "rb") as f:
+                inputs.append((os.path.basename(path), f.read()))
+    for width, height in SYNTHETIC_SIZES:
+        inputs.append((f"synthetic_{width}x{height}", make_synthetic_facade(width, height, seed)))
+    return inputs
+
+def percentile_summary(durations):
+    durations = np.asarray(durations) * 1000
+    return {
+        "runs": len(durations),
+        "mean_ms": float(durations.mean()),
+        "p50_ms": float(np.percentile(durations, 50)),
+        "p95_ms": float(np.percentile(durations, 95)),
+    }
+
+# Run fn `repeats` times after `warmup` untimed runs; returns the durations and the last result
+def time_stage(fn, repeats, warmup=1):
+    for _ in range(warmup):
+        result = fn()
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        durations.append(time.perf_counter() - start)
+    return durations, result
+
+def benchmark_image(name, image_data, args, model, device):
+    stages = {}
+    durations, (image, scale) = time_stage(lambda: decode_image(image_data, args.max_side), args.repeats)
+    stages["decode"] = durations
+    outputs = {"size": [int(image.shape[1]), int(image.shape[0])]}
+
+    if model is not None:
+        stages["preprocess"], tensor = time_stage(lambda: image_to_tensor(image, device), args.repeats)
+
+        def forward():
+            torch.manual_seed(args.seed)
+            with torch.no_grad():
+                output = model([tensor])[0]
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            return output
+        stages["model_forward"], output = time_stage(forward, args.model_repeats)
+
+        def linearize():
+            compact = compact_output(output, args.threshold, args.target_class_id)
+            return linearize_predictions(compact, args.threshold, args.target_class_id, scale)
+        stages["mask_linearization"], predictions = time_stage(linearize, args.repeats)
+        outputs["detections"] = len(predictions)
+
+    gray = get_grayscale(image)
+    stages["canny"], edges = time_stage(lambda: get_canny_edges(gray, args.sigma), args.repeats)
+    stages["hough"], lines = time_stage(
+        lambda: get_hough_lines(edges, args.line_len, args.line_gap, rng=args.seed), args.repeats)
+    outputs["lines"] = int(lines.shape[0])
+
+    if args.solver == "joint":
+        def ransac_joint():
+            np.random.seed(args.seed)
+            return run_multi_vp_ransac(lines, args.iterations, args.angle_threshold, workers=args.solver_threads)
+        stages["ransac_joint"], (hypothesis_list, _) = time_stage(ransac_joint, args.repeats)
+        outputs["vanishing_points"] = [[float(v) for v in hypothesis[:2] / hypothesis[2] / scale]
+                                       for hypothesis in hypothesis_list if hypothesis is not None]
+        return summarize(name, stages, outputs)
+
+    # The three RANSAC passes as in get_vp_inliers, each reseeded so every repeat draws the same samples
+    ignore_pts = None
+    vanishing_points = []
+    for index in range(3):
+        def ransac():
+            np.random.seed(args.seed + index)
+            return run_line_ransac_batched(lines, args.iterations, args.angle_threshold, ignore_pts=ignore_pts)
+        stages[f"ransac_pass_{index + 1}"], (hypothesis, inliers) = time_stage(ransac, args.repeats)
+        if hypothesis is None:
+            break
+        vanishing_points.append([float(v) for v in hypothesis[:2] / hypothesis[2] / scale])
+        ignore_pts = inliers if ignore_pts is None else np.logical_or(ignore_pts, inliers)
+    outputs["vanishing_points"] = vanishing_points
+    return summarize(name, stages, outputs)
+
+def summarize(name, stages, outputs):
+    summary = {stage: percentile_summary(durations) for stage, durations in stages.items()}
+    total_ms = sum(stat["p50_ms"] for stat in summary.values())
+    return {"image": name, "stages": summary, "total_p50_ms": total_ms,
+            "throughput_images_per_s": 1000 / total_ms if total_ms else None, "outputs": outputs}
+
+# Print the p50 ratio of every stage against a previous run and return the regressions
+def compare(results, baseline, tolerance):
+    baseline_by_image = {entry["image"]: entry for entry in baseline["results"]}
+    regressions = []
+    print(f"\n{'image':28} {'stage':20} {'before ms':>10} {'after ms':>10} {'ratio':>7}")
+    for entry in results:
+        previous = baseline_by_image.get(entry["image"])
+        if previous is None:
+            continue
+        for stage, stat in entry["stages"].items():
+            if stage not in previous["stages"]:
+                continue
+            before, after = previous["stages"][stage]["p50_ms"], stat["p50_ms"]
+            ratio = after / before if before else float("inf")
+            flag = " <-- slower" if ratio > 1 + tolerance else ""
+            if flag:
+                regressions.append((entry["image"], stage, ratio))
+            print(f"{entry['image'][:28]:28} {stage:20} {before:10.2f} {after:10.2f} {ratio:7.2f}{flag}")
+        if entry["outputs"] != previous["outputs"]:
+            print(f"{entry['image'][:28]:28} outputs differ from the baseline")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the segmentation and vanishing point pipelines")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", help="previous results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed p50 slowdown before flagging")
+    parser.add_argument("--images", default=SAMPLE_IMAGES)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--model-repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-model", action="store_true", help="only benchmark the VP pipeline")
+    parser.add_argument("--backend", default="eager", choices=["eager", "torchscript", "onnx"])
+    parser.add_argument("--model-path", default=os.path.join(BACKEND_DIR, "models", "best_model.pth"))
+    parser.add_argument("--num-classes", type=int, default=12)
+    parser.add_argument("--threshold", type=float, default=0.5)
+    parser.add_argument("--target-class-id", type=int, default=10)
+    parser.add_argument("--max-side", type=int, default=None)
+    parser.add_argument("--sigma", type=float, default=5.0)
+    parser.add_argument("--iterations", type=int, default=3000)
+    parser.add_argument("--line-len", type=int, default=11)
+    parser.add_argument("--line-gap", type=int, default=7)
+    parser.add_argument("--angle-threshold", type=float, default=2.0)
+    parser.add_argument("--solver", default="sequential", choices=SOLVERS,
+                        help="time the three RANSAC passes or the joint multi-VP search")
+    parser.add_argument("--solver-threads", type=int, default=None)
+    args = parser.parse_args()
+
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    model = None if args.no_model else load_backend(args.backend, args.model_path, args.num_classes, device)
+
+    results = []
+    for name, image_data in load_inputs(args.images, args.seed):
+        entry = benchmark_image(name, image_data, args, model, device)
+        results.append(entry)
+        stages = ", ".join(f"{stage} {stat['p50_ms']:.1f}" for stage, stat in entry["stages"].items())
+        print(f"{name[:40]:40} {entry['total_p50_ms']:9.1f} ms  ({stages})")
+
+    report = {
+        "meta": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "numpy": np.__version__,
+            "device": str(device),
+            "cpu_count": os.cpu_count(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved results to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} stage(s) slower than the baseline by more than {args.tolerance:.0%}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
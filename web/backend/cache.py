@@ -0,0 +1,147 @@
+import asyncio
+import hashlib
+import os
+import pickle
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+# Content hash of an uploaded image, the base of every cache key
+def image_hash(image_data):
+    return hashlib.sha256(image_data).hexdigest()
+
+def make_key(*parts):
+    return ":".join(str(part) for part in parts)
+
+# Approximate memory footprint of a cached value, dominated by its arrays
+def estimate_size(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(estimate_size(v) for v in value.values()) + sys.getsizeof(value)
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_size(v) for v in value) + sys.getsizeof(value)
+    return sys.getsizeof(value)
+
+
+class ResultCache:
+    # Two-tier cache: an LRU dict bounded by max_memory_bytes, backed by pickle files in disk_dir
+    # bounded by max_disk_bytes (least recently used files are evicted first). disk_dir=None keeps
+    # everything in memory. The async methods run the disk tier in `executor` (None: the loop's
+    # default executor) so a slow disk does not block the event loop.
+    def __init__(self, max_memory_bytes, disk_dir=None, max_disk_bytes=0, executor=None):
+        self.max_memory_bytes = max_memory_bytes
+        self.executor = executor
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.disk_bytes = 0
+        self.lock = threading.Lock()
+        self.enabled = max_memory_bytes > 0 or (disk_dir is not None and max_disk_bytes > 0)
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+            self.disk_bytes = sum(os.path.getsize(path) for path in self._disk_files())
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key][0]
+        value = self._read_disk(key)
+        if value is not None:
+            self._put_memory(key, value)
+        return value
+
+    def put(self, key, value):
+        self._put_memory(key, value)
+        self._write_disk(key, value)
+
+    # Same as get, reading the disk tier in the executor on a memory miss
+    async def get_async(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key][0]
+        if self.disk_dir is None:
+            return None
+        value = await asyncio.get_running_loop().run_in_executor(self.executor, self._read_disk, key)
+        if value is not None:
+            self._put_memory(key, value)
+        return value
+
+    # Same as put, pickling and writing the disk entry in the executor
+    async def put_async(self, key, value):
+        self._put_memory(key, value)
+        if self.disk_dir is not None and self.max_disk_bytes > 0:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self._write_disk, key, value)
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            self.memory_bytes = 0
+
+    def _put_memory(self, key, value):
+        size = estimate_size(value)
+        if size > self.max_memory_bytes:
+            return
+        with self.lock:
+            if key in self.memory:
+                self.memory_bytes -= self.memory.pop(key)[1]
+            self.memory[key] = (value, size)
+            self.memory_bytes += size
+            while self.memory_bytes > self.max_memory_bytes:
+                _, (_, evicted_size) = self.memory.popitem(last=False)
+                self.memory_bytes -= evicted_size
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, hashlib.sha256(key.encode()).hexdigest() + ".pkl")
+
+    def _disk_files(self):
+        return [os.path.join(self.disk_dir, name) for name in os.listdir(self.disk_dir) if name.endswith(".pkl")]
+
+    def _read_disk(self, key):
+        if self.disk_dir is None:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+            os.utime(path)  # Mark as recently used for eviction
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        return value
+
+    def _write_disk(self, key, value):
+        if self.disk_dir is None or self.max_disk_bytes <= 0:
+            return
+        path = self._disk_path(key)
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_disk_bytes:
+            return
+        with self.lock:
+            if os.path.exists(path):
+                self.disk_bytes -= os.path.getsize(path)
+            # Write then rename so a crash never leaves a truncated entry behind
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            self.disk_bytes += len(data)
+            if self.disk_bytes > self.max_disk_bytes:
+                self._evict_disk()
+
+    def _evict_disk(self):
+        files = sorted(self._disk_files(), key=os.path.getmtime)
+        for path in files:
+            if self.disk_bytes <= self.max_disk_bytes:
+                break
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+            except OSError:
+                continue
+            self.disk_bytes -= size
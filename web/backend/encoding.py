@@ -0,0 +1,120 @@
+import json
+import struct
+
+import numpy as np
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # Listed in requirements.txt; the slower standard json module is used without it
+    orjson = None
+
+# Media type of the packed array format, requested with an Accept header or format=binary
+BINARY_MEDIA_TYPE = "application/vnd.glassfinder.arrays"
+BINARY_MAGIC = b"GFA1"
+BINARY_ALIGNMENT = 8
+
+# JSONResponse serialized with orjson when it is installed, which also accepts numpy scalars and arrays
+class FastJSONResponse(JSONResponse):
+    def render(self, content):
+        if orjson is None:
+            return super().render(content)
+        return dumps(content)
+
+# JSON bytes of a response body, as FastJSONResponse would send it
+def dumps(content):
+    if orjson is None:
+        return json.dumps(content, separators=(",", ":")).encode()
+    return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY)
+
+def loads(data):
+    if orjson is None:
+        return json.loads(data)
+    return orjson.loads(data)
+
+# Run lengths of a binary mask flattened in row-major order, starting with a run of zeros (possibly
+# empty), so runs alternate between background and mask pixels
+def rle_encode(mask):
+    flat = mask.reshape(-1)
+    if flat.size == 0:
+        return np.zeros(0, dtype=np.uint32)
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    bounds = np.concatenate([[0], changes, [flat.size]])
+    runs = np.diff(bounds)
+    if flat[0]:
+        runs = np.concatenate([[0], runs])
+    return runs.astype(np.uint32)
+
+def rle_decode(runs, height, width):
+    values = np.arange(len(runs)) % 2 == 1
+    return np.repeat(values, runs).reshape(height, width)
+
+# JSON form of one cropped mask: its window in image pixels and the run lengths of rle_encode
+def encode_mask(mask_crop, offset):
+    return {
+        "x": int(offset[0]),
+        "y": int(offset[1]),
+        "width": int(mask_crop.shape[1]),
+        "height": int(mask_crop.shape[0]),
+        "counts": rle_encode(mask_crop).tolist(),
+    }
+
+# Binary container of named arrays: the magic bytes, the header length as a little-endian uint32,
+# a JSON header giving `meta` and the dtype, shape and byte offset of every array, then the raw
+# little-endian array data. Offsets count from the start of the data, which follows the header.
+# The header is padded so that the data, and each array in it, starts on an 8-byte boundary of the
+# body: clients can view every array in place (e.g. a JavaScript Int32Array over the response).
+def pack_arrays(arrays, meta=None):
+    arrays = {name: np.ascontiguousarray(array, dtype=np.dtype(array.dtype).newbyteorder("<"))
+              for name, array in arrays.items()}
+    specs, parts, position = {}, [], 0
+    for name, array in arrays.items():
+        specs[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": position}
+        padding = -array.nbytes % BINARY_ALIGNMENT
+        parts += [array.tobytes(), b"\0" * padding]
+        position += array.nbytes + padding
+    header = json.dumps({"meta": meta or {}, "arrays": specs}, separators=(",", ":")).encode()
+    header += b" " * (-(len(BINARY_MAGIC) + 4 + len(header)) % BINARY_ALIGNMENT)
+    return b"".join([BINARY_MAGIC, struct.pack("<I", len(header)), header] + parts)
+
+def unpack_arrays(data):
+    if data[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+        raise ValueError("not a packed array response")
+    header_length, = struct.unpack_from("<I", data, len(BINARY_MAGIC))
+    start = len(BINARY_MAGIC) + 4
+    header = json.loads(data[start:start + header_length])
+    data_start = start + header_length
+    arrays = {}
+    for name, spec in header["arrays"].items():
+        count = int(np.prod(spec["shape"]))
+        arrays[name] = np.frombuffer(data, dtype=np.dtype(spec["dtype"]), count=count,
+                                     offset=data_start + spec["offset"]).reshape(spec["shape"])
+    return header["meta"], arrays
+
+# Packed form of linearized detections (inference.linearize_detections). Per detection: class_ids,
+# scores and boxes (x0, y0, x1, y1 in original pixels) and contour_counts; contours holds every
+# quadrilateral, (total contours, 4, 2), in detection order. With include_masks, mask_windows gives
+# each mask's (x, y, width, height) in the pixels the model saw (original pixels times mask_scale),
+# mask_run_counts the number of runs of each mask and mask_runs all rle_encode runs concatenated
+# (uint16 when every run fits, uint32 otherwise).
+def pack_predictions(output, indices, contours, scale=1.0, include_masks=False):
+    arrays = {
+        "class_ids": output['labels'][indices].astype(np.int32),
+        "scores": output['scores'][indices].astype(np.float32),
+        "boxes": (output['boxes'][indices].reshape(-1, 4) / scale).astype(np.int32),
+        "contour_counts": np.array([len(c) for c in contours], dtype=np.int32),
+        "contours": (np.concatenate(contours) if contours else np.zeros((0, 4, 2))).astype(np.int32),
+    }
+    meta = {"count": len(indices)}
+    if include_masks:
+        masks = [output['masks'][i] for i in indices]
+        runs = [rle_encode(mask) for mask in masks]
+        offsets = output['mask_offsets'][indices].reshape(-1, 2)
+        arrays["mask_windows"] = np.array([[x, y, mask.shape[1], mask.shape[0]]
+                                           for (x, y), mask in zip(offsets, masks)], dtype=np.int32).reshape(-1, 4)
+        arrays["mask_run_counts"] = np.array([len(r) for r in runs], dtype=np.int32)
+        mask_runs = np.concatenate(runs) if runs else np.zeros(0, dtype=np.uint32)
+        # Most runs are shorter than a mask row, so 16 bits usually suffice
+        arrays["mask_runs"] = mask_runs.astype(np.uint16) if mask_runs.size and mask_runs.max() < 1 << 16 else mask_runs
+        meta["mask_scale"] = scale
+    return pack_arrays(arrays, meta)
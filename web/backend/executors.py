@@ -0,0 +1,77 @@
+import asyncio
+import functools
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import metrics
+
+
+class Saturated(Exception):
+    # Raised instead of queueing more work; the API answers 429 with a Retry-After hint
+    def __init__(self, name, retry_after=1):
+        super().__init__(f"{name} is saturated, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class BoundedExecutor:
+    # Wraps a thread or process pool so at most max_pending calls are queued or running at once
+    def __init__(self, name, executor, max_pending, retry_after=1):
+        self.name = name
+        self.executor = executor
+        self.max_pending = max_pending
+        self.retry_after = retry_after
+        self.pending = 0
+
+    async def run(self, fn, *args, **kwargs):
+        if self.pending >= self.max_pending:
+            raise Saturated(self.name, self.retry_after)
+        self.pending += 1
+        try:
+            if not metrics.enabled:
+                return await asyncio.get_running_loop().run_in_executor(
+                    self.executor, functools.partial(fn, *args, **kwargs))
+            submitted = time.time()
+            started, result = await asyncio.get_running_loop().run_in_executor(
+                self.executor, functools.partial(timed_call, fn, args, kwargs))
+            metrics.queue_wait_seconds.observe(max(0.0, started - submitted), self.name)
+            return result
+        finally:
+            self.pending -= 1
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Runs in the worker and reports when it started, to measure the time spent queued. Wall-clock time
+# so it stays comparable across processes.
+def timed_call(fn, args, kwargs):
+    started = time.time()
+    return started, fn(*args, **kwargs)
+
+
+class ConcurrencyLimiter:
+    # Per-endpoint cap on requests in flight, used as `async with limiter:`
+    def __init__(self, name, max_concurrent, retry_after=1):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.retry_after = retry_after
+        self.active = 0
+
+    async def __aenter__(self):
+        if self.active >= self.max_concurrent:
+            raise Saturated(self.name, self.retry_after)
+        self.active += 1
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.active -= 1
+
+
+# Torch releases the GIL during inference so threads are enough; the NumPy/skimage VP pipeline
+# holds it for long stretches and gets its own processes unless kind is "thread"
+def make_executor(kind, max_workers):
+    if kind == "process":
+        # spawn avoids forking a parent that already started torch and executor threads
+        return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+    return ThreadPoolExecutor(max_workers=max_workers)
@@ -0,0 +1,130 @@
+# Export the trained Mask R-CNN to a TorchScript or ONNX artifact for CPU serving, optionally with
+# dynamic int8 quantization of the box head linear layers, and compare it with the eager model.
+#
+#   python export_model.py --format torchscript --quantize --output models/best_model_int8.pt
+#   GLASSFINDER_MODEL_BACKEND=torchscript GLASSFINDER_MODEL_PATH=models/best_model_int8.pt \
+#       python -m uvicorn app:app
+import argparse
+import glob
+import os
+import time
+
+import numpy as np
+import torch
+from torchvision.ops import box_iou
+
+from imaging import decode_image
+from inference import load_backend, load_model, run_model
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+SAMPLE_IMAGES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "maskrcnn", "images")
+
+
+def export_torchscript(model, output_path, quantize=False):
+    if quantize:
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    torch.jit.script(model).save(output_path)
+
+def export_onnx(model, output_path, quantize=False, opset_version=11):
+    sample = torch.rand(3, 800, 800)
+    torch.onnx.export(model, ([sample],), output_path, opset_version=opset_version,
+                      input_names=["image"], output_names=["boxes", "labels", "scores", "masks"],
+                      dynamic_axes={"image": {1: "height", 2: "width"}, "boxes": {0: "detections"},
+                                    "labels": {0: "detections"}, "scores": {0: "detections"},
+                                    "masks": {0: "detections", 2: "height", 3: "width"}},
+                      dynamo=False)
+    if quantize:
+        # ONNX Runtime quantizes the fully connected (MatMul/Gemm) weights, i.e. the box head
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        float_path = output_path + ".fp32"
+        os.replace(output_path, float_path)
+        quantize_dynamic(float_path, output_path, op_types_to_quantize=["MatMul", "Gemm"],
+                         weight_type=QuantType.QInt8)
+        os.remove(float_path)
+
+# Greedy same-class IoU matching of the detections above threshold
+def match_detections(reference, candidate, threshold):
+    ref_keep = reference['scores'] >= threshold
+    cand_keep = candidate['scores'] >= threshold
+    ref_boxes, ref_labels, ref_scores = (reference[k][ref_keep] for k in ('boxes', 'labels', 'scores'))
+    cand_boxes, cand_labels, cand_scores = (candidate[k][cand_keep] for k in ('boxes', 'labels', 'scores'))
+    if len(ref_boxes) == 0 or len(cand_boxes) == 0:
+        return len(ref_boxes), len(cand_boxes), [], []
+    ious = box_iou(ref_boxes, cand_boxes)
+    ious[ref_labels[:, None] != cand_labels[None, :]] = 0
+    matched_ious, score_diffs = [], []
+    for i in range(len(ref_boxes)):
+        j = int(ious[i].argmax())
+        if ious[i, j] >= 0.5:
+            matched_ious.append(float(ious[i, j]))
+            score_diffs.append(abs(float(ref_scores[i] - cand_scores[j])))
+            ious[:, j] = 0
+    return len(ref_boxes), len(cand_boxes), matched_ious, score_diffs
+
+def timed_forward(model, image):
+    start = time.perf_counter()
+    output = run_model(model, [image], torch.device("cpu"))[0]
+    return {k: v.cpu() for k, v in output.items()}, time.perf_counter() - start
+
+def check_accuracy(reference, candidate, image_paths, threshold):
+    print(f"{'image':40} {'eager':>6} {'export':>6} {'matched':>7} {'mean IoU':>8} {'max dscore':>10} "
+          f"{'eager s':>8} {'export s':>8}")
+    totals = {"reference": 0, "matched": 0, "reference_time": 0.0, "candidate_time": 0.0}
+    for index, path in enumerate(image_paths):
+        with open(path, "rb") as f:
+            image, _ = decode_image(f.read())
+        if index == 0:
+            # Keep one-time initialization (JIT profiling, allocator) out of the timings
+            timed_forward(reference, image)
+            timed_forward(candidate, image)
+        ref_output, ref_time = timed_forward(reference, image)
+        cand_output, cand_time = timed_forward(candidate, image)
+        ref_count, cand_count, ious, score_diffs = match_detections(ref_output, cand_output, threshold)
+        totals["reference"] += ref_count
+        totals["matched"] += len(ious)
+        totals["reference_time"] += ref_time
+        totals["candidate_time"] += cand_time
+        print(f"{os.path.basename(path)[:40]:40} {ref_count:6d} {cand_count:6d} {len(ious):7d} "
+              f"{np.mean(ious) if ious else float('nan'):8.3f} {max(score_diffs, default=0.0):10.4f} "
+              f"{ref_time:8.2f} {cand_time:8.2f}")
+    recall = totals["matched"] / totals["reference"] if totals["reference"] else 1.0
+    speedup = totals["reference_time"] / totals["candidate_time"] if totals["candidate_time"] else float("nan")
+    print(f"Detections recovered: {recall:.1%}, speed-up: x{speedup:.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the Mask R-CNN for optimized CPU inference")
+    parser.add_argument("--weights", default="models/best_model.pth")
+    parser.add_argument("--num-classes", type=int, default=12)
+    parser.add_argument("--format", choices=["torchscript", "onnx"], default="torchscript")
+    parser.add_argument("--quantize", action="store_true", help="dynamic int8 quantization of the heads")
+    parser.add_argument("--output", help="artifact path (default: next to the weights)")
+    parser.add_argument("--check-images", default=SAMPLE_IMAGES,
+                        help="directory of images to compare the artifact against the eager model on")
+    parser.add_argument("--score-threshold", type=float, default=0.5)
+    parser.add_argument("--skip-check", action="store_true")
+    args = parser.parse_args()
+
+    device = torch.device("cpu")
+    output = args.output
+    if output is None:
+        suffix = ("_int8" if args.quantize else "") + (".pt" if args.format == "torchscript" else ".onnx")
+        output = os.path.splitext(args.weights)[0] + suffix
+
+    model = load_model(args.weights, args.num_classes, device)
+    if args.format == "torchscript":
+        export_torchscript(model, output, args.quantize)
+    else:
+        export_onnx(model, output, args.quantize)
+    print(f"Exported {args.format}{' (int8 heads)' if args.quantize else ''} model to {output}")
+
+    if args.skip_check:
+        return
+    image_paths = sorted(path for path in glob.glob(os.path.join(args.check_images, "*"))
+                         if path.lower().endswith(IMAGE_EXTENSIONS))
+    if not image_paths:
+        raise SystemExit(f"No images to check the export against in {args.check_images}")
+    exported = load_backend(args.format, output, args.num_classes, device)
+    check_accuracy(model, exported, image_paths, args.score_threshold)
+
+if __name__ == "__main__":
+    main()
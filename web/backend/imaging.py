@@ -0,0 +1,19 @@
+from PIL import Image
+import numpy as np
+import io
+
+# Decode an uploaded image once, in memory, to an RGB uint8 array shared by the torch and skimage
+# consumers. With max_side the image is downscaled so its longest side is at most max_side pixels;
+# scale is the factor from original to processed pixel coordinates.
+def decode_image(image_data, max_side=None):
+    assert max_side is None or max_side > 0, "max_side must be positive"
+    image = Image.open(io.BytesIO(image_data))
+    scale = 1.0
+    if max_side is not None and max(image.size) > max_side:
+        scale = max_side / max(image.size)
+        size = (max(1, round(image.size[0] * scale)), max(1, round(image.size[1] * scale)))
+        image.draft("RGB", size)  # Lets the JPEG decoder skip straight to a reduced resolution
+        image = image.convert("RGB").resize(size, Image.BILINEAR)
+    else:
+        image = image.convert("RGB")
+    return np.array(image), scale
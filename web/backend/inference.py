@@ -0,0 +1,318 @@
+import torch
+import torchvision
+import numpy as np
+import cv2
+import time
+from concurrent.futures import ThreadPoolExecutor
+from torchvision.models.detection.faster_rcnn import FastRCNNPredictor
+from torchvision.models.detection.mask_rcnn import MaskRCNNPredictor
+from imaging import decode_image
+from encoding import encode_mask
+
+# Load the trained model. Every parameter comes from the checkpoint, so no pretrained backbone is
+# fetched. The checkpoint is memory-mapped and its tensors are used in place (assign=True): on CPU the
+# weights stay backed by the page cache, which server workers loading the same file share.
+def load_model(weights_path, num_classes, device):
+    model = torchvision.models.detection.maskrcnn_resnet50_fpn(weights=None, weights_backbone=None)
+    in_features = model.roi_heads.box_predictor.cls_score.in_features
+    model.roi_heads.box_predictor = FastRCNNPredictor(in_features, num_classes)
+    in_features_mask = model.roi_heads.mask_predictor.conv5_mask.in_channels
+    hidden_layer = 256
+    model.roi_heads.mask_predictor = MaskRCNNPredictor(in_features_mask, hidden_layer, num_classes)
+
+    # Load weights and set model to evaluation mode
+    try:
+        state_dict = torch.load(weights_path, map_location=device, mmap=True, weights_only=True)
+    except RuntimeError:
+        # Checkpoints in the legacy (non-zip) format cannot be memory-mapped
+        state_dict = torch.load(weights_path, map_location=device, weights_only=True)
+    model.load_state_dict(state_dict, assign=True)
+    model.to(device).eval()
+    return model
+
+# Same result as T.ToTensor() on a decoded HWC uint8 array, but converted after the transfer so
+# only the uint8 pixels are copied to the device
+def image_to_tensor(image, device=None):
+    return torch.from_numpy(image).to(device).permute(2, 0, 1).float().div_(255)
+
+# Serves a TorchScript artifact written by export_model.py with the eager model's call signature
+class TorchScriptModel:
+    def __init__(self, path, device):
+        self.module = torch.jit.load(path, map_location=device).eval()
+
+    def __call__(self, images):
+        _, detections = self.module(images)  # Scripted detection models return (losses, detections)
+        return detections
+
+# Serves an ONNX artifact written by export_model.py; the graph takes one image so batches are
+# run image by image. Needs the optional onnxruntime package.
+class OnnxModel:
+    def __init__(self, path):
+        import onnxruntime
+        self.session = onnxruntime.InferenceSession(path, providers=onnxruntime.get_available_providers())
+
+    def __call__(self, images):
+        outputs = []
+        for image in images:
+            boxes, labels, scores, masks = self.session.run(None, {"image": image.cpu().numpy()})
+            outputs.append({
+                'boxes': torch.from_numpy(boxes),
+                'labels': torch.from_numpy(labels),
+                'scores': torch.from_numpy(scores),
+                'masks': torch.from_numpy(masks),
+            })
+        return outputs
+
+# Load the model for one of the serving backends: "eager" (weights file), "torchscript" or "onnx"
+# (artifacts from export_model.py)
+def load_backend(backend, path, num_classes, device):
+    if backend == "eager":
+        return load_model(path, num_classes, device)
+    if backend == "torchscript":
+        return TorchScriptModel(path, device)
+    if backend == "onnx":
+        return OnnxModel(path)
+    raise ValueError(f"Unknown model backend: {backend}")
+
+# Preprocess the image
+def preprocess_image(image_data):
+    image, _ = decode_image(image_data)
+    return image_to_tensor(image).unsqueeze(0)  # add batch dimension
+
+# Run one forward pass over a list of CHW image tensors or decoded HWC arrays, possibly of different sizes
+def run_model(model, images, device):
+    images = [image_to_tensor(image, device) if isinstance(image, np.ndarray) else image.to(device)
+              for image in images]
+    with torch.no_grad():
+        return model(images)
+
+# Mask R-CNN pastes each 28x28 mask into its box enlarged by (28 + 2) / 28 (torchvision's
+# paste_masks_in_image), so no mask pixel lies outside that window
+MASK_PASTE_SCALE = (28 + 2) / 28
+
+# Reduce a model output on its device before moving it to CPU: optionally keep only the detections
+# passing the score/class filter, then crop each mask to its pasted box window and binarize it.
+# Crops are copied to the host in one transfer and stored with their (x, y) offsets in the image.
+def compact_output(output, threshold=None, target_class_id=None):
+    boxes, labels, scores, masks = output['boxes'], output['labels'], output['scores'], output['masks']
+    keep = torch.arange(scores.shape[0], device=scores.device)
+    if threshold is not None:
+        keep = torch.nonzero((scores >= threshold) & (labels == target_class_id)).flatten()
+        boxes, labels, scores = boxes[keep], labels[keep], scores[keep]
+
+    height, width = masks.shape[-2:]
+    center = (boxes[:, :2] + boxes[:, 2:]) / 2
+    half_size = (boxes[:, 2:] - boxes[:, :2]) / 2 * MASK_PASTE_SCALE
+    low = torch.floor(center - half_size) - 1
+    high = torch.ceil(center + half_size) + 2
+    limits = torch.tensor([width, height], device=boxes.device)
+    extents = torch.cat([low.clamp(min=0), torch.minimum(high, limits)], dim=1).long().cpu().numpy()
+    extents[:, 2:] = np.maximum(extents[:, 2:], extents[:, :2])
+
+    crops = [masks[i, 0, y0:y1, x0:x1] > 0.5 for i, (x0, y0, x1, y1) in zip(keep.tolist(), extents)]
+    flat = torch.cat([crop.reshape(-1) for crop in crops]).cpu().numpy() if crops else np.zeros(0, dtype=bool)
+    sizes = [(y1 - y0) * (x1 - x0) for x0, y0, x1, y1 in extents]
+    mask_crops = [chunk.reshape(y1 - y0, x1 - x0)
+                  for chunk, (x0, y0, x1, y1) in zip(np.split(flat, np.cumsum(sizes)[:-1]), extents)]
+    return {
+        'boxes': boxes.cpu().detach().numpy(),
+        'labels': labels.cpu().detach().numpy(),
+        'scores': scores.cpu().detach().numpy(),
+        'masks': mask_crops,
+        'mask_offsets': extents[:, :2],
+    }
+
+# Smallest tile worth a model call: below it a window barely fits and the tile count explodes
+MIN_TILE_SIZE = 64
+
+# Tiles of at most tile_size pixels covering a height x width image, overlapping by at least
+# `overlap` pixels, as (x0, y0, x1, y1). The last row and column are aligned on the image border.
+def get_tiles(height, width, tile_size=800, overlap=128):
+    if tile_size < MIN_TILE_SIZE:
+        raise ValueError(f"tile size must be at least {MIN_TILE_SIZE}")
+    if not 0 <= overlap < tile_size:
+        raise ValueError("tile overlap must be in [0, tile size)")
+
+    def starts(length):
+        if length <= tile_size:
+            return [0]
+        count = int(np.ceil((length - overlap) / (tile_size - overlap)))
+        return np.linspace(0, length - tile_size, count).round().astype(int).tolist()
+
+    return [(x0, y0, min(x0 + tile_size, width), min(y0 + tile_size, height))
+            for y0 in starts(height) for x0 in starts(width)]
+
+# Overlap of two cropped masks relative to the smaller one, so a detection cut by a tile border
+# counts as a duplicate of the complete detection from the neighbouring tile
+def mask_overlap(mask_a, offset_a, mask_b, offset_b):
+    x0, y0 = max(offset_a[0], offset_b[0]), max(offset_a[1], offset_b[1])
+    x1 = min(offset_a[0] + mask_a.shape[1], offset_b[0] + mask_b.shape[1])
+    y1 = min(offset_a[1] + mask_a.shape[0], offset_b[1] + mask_b.shape[0])
+    smaller = min(mask_a.sum(), mask_b.sum())
+    if x1 <= x0 or y1 <= y0 or smaller == 0:
+        return 0.0
+    window_a = mask_a[y0 - offset_a[1]:y1 - offset_a[1], x0 - offset_a[0]:x1 - offset_a[0]]
+    window_b = mask_b[y0 - offset_b[1]:y1 - offset_b[1], x0 - offset_b[0]:x1 - offset_b[0]]
+    return np.logical_and(window_a, window_b).sum() / smaller
+
+# Combine the compact outputs of the tiles of one image into a compact output in image coordinates.
+# Detections of the same class whose masks overlap by more than overlap_threshold (of the smaller
+# mask) are merged greedily by decreasing score, preferring detections away from inner tile borders
+# between equal scores. Kept detections are indexed by the cell_size grid cells their boxes cover,
+# so each detection is only compared with the kept ones around it.
+def merge_tile_outputs(outputs, tiles, height, width, overlap_threshold=0.5, border_margin=2, cell_size=128):
+    boxes, offsets, masks, labels, scores, on_border = [], [], [], [], [], []
+    for output, (x0, y0, x1, y1) in zip(outputs, tiles):
+        tile_boxes = output['boxes'] + [x0, y0, x0, y0]
+        boxes.append(tile_boxes)
+        offsets.append(output['mask_offsets'] + [x0, y0])
+        masks += output['masks']
+        labels.append(output['labels'])
+        scores.append(output['scores'])
+        # Edges shared with a neighbouring tile, where objects may be cut
+        on_border.append(((tile_boxes[:, 0] <= x0 + border_margin) & (x0 > 0)) |
+                         ((tile_boxes[:, 1] <= y0 + border_margin) & (y0 > 0)) |
+                         ((tile_boxes[:, 2] >= x1 - border_margin) & (x1 < width)) |
+                         ((tile_boxes[:, 3] >= y1 - border_margin) & (y1 < height)))
+    boxes, offsets = np.concatenate(boxes).reshape(-1, 4), np.concatenate(offsets).reshape(-1, 2)
+    labels, scores = np.concatenate(labels), np.concatenate(scores)
+    on_border = np.concatenate(on_border)
+
+    cells = {}
+    keep = []
+    for i in np.lexsort((on_border, -scores)):
+        cx0, cy0, cx1, cy1 = (np.maximum(boxes[i], 0) // cell_size).astype(int)
+        box_cells = [(cx, cy) for cx in range(cx0, cx1 + 1) for cy in range(cy0, cy1 + 1)]
+        # Pairs whose boxes do not intersect cannot overlap
+        neighbours = {j for cell in box_cells for j in cells.get(cell, ())
+                      if labels[j] == labels[i] and
+                      (np.minimum(boxes[i, 2:], boxes[j, 2:]) > np.maximum(boxes[i, :2], boxes[j, :2])).all()}
+        if any(mask_overlap(masks[i], offsets[i], masks[j], offsets[j]) > overlap_threshold for j in neighbours):
+            continue
+        keep.append(i)
+        for cell in box_cells:
+            cells.setdefault(cell, []).append(i)
+    return {
+        'boxes': boxes[keep],
+        'labels': labels[keep],
+        'scores': scores[keep],
+        'masks': [masks[i] for i in keep],
+        'mask_offsets': offsets[keep],
+    }
+
+# Approximate the external contours of one cropped mask with quadrilaterals, in image pixels, as an
+# int array of shape (contours, 4, 2). Returns None when any contour does not simplify to exactly 4 points.
+def linearize_mask(mask_crop, offset, scale=1.0):
+    if mask_crop.size == 0:
+        return np.zeros((0, 4, 2), dtype=int)
+    contours, _ = cv2.findContours(mask_crop.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE,
+                                   offset=(int(offset[0]), int(offset[1])))
+    linearized_contours = []
+    for contour in contours:
+        # Approximate contour with linear segments
+        epsilon = 0.04 * cv2.arcLength(contour, True)  # Approximation factor
+        approx = cv2.approxPolyDP(contour, epsilon, True)
+
+        if len(approx) != 4:
+            return None  # Discard the prediction if any contour is not a quadrilateral
+
+        linearized_contours.append(approx.reshape(-1, 2))  # Flatten contour to list of points
+    linearized_contours = np.array(linearized_contours, dtype=int).reshape(-1, 4, 2)
+    if scale != 1.0:
+        linearized_contours = np.round(linearized_contours / scale).astype(int)
+    return linearized_contours
+
+# Indices of the target class detections whose mask linearizes to quadrilaterals, with their
+# contours. Accepts a raw model output or one reduced with compact_output; coordinates are divided
+# by scale to map them back to the original image when it was downscaled before inference. With an
+# executor the masks are linearized in parallel (OpenCV releases the GIL) once their crops total
+# min_parallel_pixels.
+def linearize_detections(output, threshold=0.5, target_class_id=10, scale=1.0, executor=None,
+                         min_parallel_pixels=1 << 20):
+    if 'mask_offsets' not in output:
+        output = compact_output(output, threshold, target_class_id)
+    keep = np.nonzero((output['scores'] >= threshold) & (output['labels'] == target_class_id))[0]
+    masks = [output['masks'][i] for i in keep]
+    offsets = [output['mask_offsets'][i] for i in keep]
+    scales = [scale] * len(keep)
+    if executor is not None and len(keep) > 1 and sum(mask.size for mask in masks) >= min_parallel_pixels:
+        linearized = list(executor.map(linearize_mask, masks, offsets, scales))
+    else:
+        linearized = list(map(linearize_mask, masks, offsets, scales))
+
+    # Skip the predictions that did not linearize
+    indices = [i for i, contours in zip(keep, linearized) if contours is not None]
+    contours = [contours for contours in linearized if contours is not None]
+    return output, np.array(indices, dtype=int), contours
+
+# Keep the target class detections whose mask linearizes to quadrilaterals (see linearize_detections),
+# as JSON-ready dicts
+def linearize_predictions(output, threshold=0.5, target_class_id=10, scale=1.0, executor=None,
+                          min_parallel_pixels=1 << 20, include_masks=False):
+    output, indices, contours = linearize_detections(output, threshold, target_class_id, scale, executor,
+                                                     min_parallel_pixels)
+    return format_predictions(output, indices, contours, scale, include_masks)
+
+# JSON form of linearized detections. With include_masks each also carries its binarized mask,
+# run-length encoded (encoding.encode_mask), in the pixels of the image the model saw.
+def format_predictions(output, indices, contours, scale=1.0, include_masks=False):
+    results = []
+    for i, linearized_contours in zip(indices, contours):
+        result = {
+            "class_id": int(output['labels'][i]),
+            "score": float(output['scores'][i]),
+            "bounding_box": (output['boxes'][i] / scale).astype(int).tolist(),
+            "linearized_contours": linearized_contours.tolist()
+        }
+        if include_masks:
+            result["mask"] = encode_mask(output['masks'][i], output['mask_offsets'][i])
+        results.append(result)
+
+    return results
+
+# Prediction function, for encoded image bytes or an already decoded RGB array
+def predict_and_linearize(model, image_data, device, threshold=0.5, target_class_id=10, max_side=None,
+                          executor=None, include_masks=False):
+    if isinstance(image_data, np.ndarray):
+        image, scale = image_data, 1.0
+    else:
+        image, scale = decode_image(image_data, max_side)
+    outputs = run_model(model, [image], device)
+    output = compact_output(outputs[0], threshold, target_class_id)
+    return linearize_predictions(output, threshold, target_class_id, scale, executor, include_masks=include_masks)
+
+class DetectionPipeline:
+    # Window segmentation with a fixed configuration (score threshold, target class, max_side) for a
+    # loaded model, keeping the thread pool that linearizes masks across calls. Used by the command
+    # line tools; the server runs the same stages through its batcher and executors.
+    def __init__(self, model, device, threshold=0.5, target_class_id=10, max_side=None, linearize_workers=4):
+        self.model = model
+        self.device = device
+        self.config = {"threshold": threshold, "target_class_id": target_class_id, "max_side": max_side}
+        self.executor = ThreadPoolExecutor(max_workers=linearize_workers) if linearize_workers > 1 else None
+
+    # JSON-ready predictions (see linearize_predictions) for an image path, encoded bytes or decoded
+    # RGB array, in original image pixels; keyword arguments override the configuration for this call
+    def predict(self, image, include_masks=False, **overrides):
+        config = dict(self.config, **overrides)
+        if isinstance(image, str):
+            with open(image, "rb") as f:
+                image = f.read()
+        return predict_and_linearize(self.model, image, self.device, config["threshold"], config["target_class_id"],
+                                     config["max_side"], self.executor, include_masks)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+# Run `runs` full predictions on a random image so that allocator growth, kernel selection and
+# lazy initialization happen before the first request. Returns the duration of each run in seconds.
+def warm_up(model, device, runs=1, height=480, width=640, target_class_id=10):
+    image = np.random.default_rng(0).integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        outputs = run_model(model, [image], device)
+        linearize_predictions(compact_output(outputs[0]), threshold=0.0, target_class_id=target_class_id)
+        durations.append(time.perf_counter() - start)
+    return durations
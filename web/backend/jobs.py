@@ -0,0 +1,287 @@
+import asyncio
+import functools
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from executors import Saturated
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+PENDING_STATUSES = (QUEUED, RUNNING)
+
+
+class JobStore:
+    # Persistent job queue: one SQLite table of jobs, and the uploaded images as files in
+    # directory/images named by content hash, so images shared by several jobs are stored once. Jobs
+    # are identified by a key (task, image hash and parameters): submitting the same key again returns
+    # the existing job, unless it failed, in which case it is queued again. Several processes may share
+    # the directory: a running job holds a lease, renewed by heartbeat(), and only jobs whose lease is
+    # older than lease_seconds (their process died) are queued again, or failed once they have been
+    # claimed max_attempts times. Finished jobs older than retention_seconds are deleted.
+    def __init__(self, directory, retention_seconds=7 * 24 * 3600, lease_seconds=60, max_attempts=3):
+        self.directory = directory
+        self.image_dir = os.path.join(directory, "images")
+        self.retention_seconds = retention_seconds
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        os.makedirs(self.image_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(directory, "jobs.sqlite3"), check_same_thread=False,
+                                  isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                key TEXT UNIQUE NOT NULL,
+                task TEXT NOT NULL,
+                params TEXT NOT NULL,
+                image_hash TEXT NOT NULL,
+                status TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL,
+                heartbeat_at REAL
+            )""")
+        columns = {row["name"] for row in self.db.execute("PRAGMA table_info(jobs)")}
+        if "heartbeat_at" not in columns:  # Stores created before leases
+            self.db.execute("ALTER TABLE jobs ADD COLUMN heartbeat_at REAL")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+        self.recover()
+        self.purge()
+
+    # Queue a job, or return the existing one with the same key. Returns (job id, True when the
+    # submission was deduplicated against an existing job).
+    def submit(self, task, params, image_hash, image_data):
+        key = make_job_key(task, params, image_hash)
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            row = self.db.execute("SELECT id, status FROM jobs WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                # The image is written before the job is committed, so a claimed job always has it
+                self._write_image(image_hash, image_data)
+                job_id = uuid.uuid4().hex
+                self.db.execute("INSERT INTO jobs (id, key, task, params, image_hash, status, created_at) "
+                                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                (job_id, key, task, json.dumps(params), image_hash, QUEUED, now))
+                return job_id, False
+            if row["status"] == FAILED:
+                self._write_image(image_hash, image_data)
+                self.db.execute("UPDATE jobs SET status = ?, error = NULL, created_at = ?, started_at = NULL, "
+                                "finished_at = NULL WHERE id = ?", (QUEUED, now, row["id"]))
+            return row["id"], True
+
+    # Mark the oldest queued job as running and return it with its image, or None when the queue is empty
+    def claim(self):
+        self.recover()
+        with self.lock, self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            row = self.db.execute("SELECT id, task, params, image_hash FROM jobs WHERE status = ? "
+                                  "ORDER BY created_at LIMIT 1", (QUEUED,)).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            self.db.execute("UPDATE jobs SET status = ?, started_at = ?, heartbeat_at = ?, attempts = attempts + 1 "
+                            "WHERE id = ?", (RUNNING, now, now, row["id"]))
+        try:
+            with open(self._image_path(row["image_hash"]), "rb") as f:
+                image_data = f.read()
+        except OSError as e:
+            self.finish(row["id"], error=f"image not found: {e}")
+            return None
+        return row["id"], row["task"], json.loads(row["params"]), image_data
+
+    # Put a claimed job back in the queue without counting the attempt, e.g. when the workers it needs
+    # are saturated
+    def release(self, job_id):
+        with self.lock:
+            self.db.execute("UPDATE jobs SET status = ?, started_at = NULL, heartbeat_at = NULL, "
+                            "attempts = attempts - 1 WHERE id = ?", (QUEUED, job_id))
+
+    # Renew the lease of a running job
+    def heartbeat(self, job_id):
+        with self.lock:
+            self.db.execute("UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND status = ?",
+                            (time.time(), job_id, RUNNING))
+
+    # Queue again the running jobs whose lease expired, or fail them after max_attempts claims (a job
+    # that kills its process would otherwise be retried forever)
+    def recover(self):
+        expired = time.time() - self.lease_seconds
+        with self.lock, self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            abandoned = [row[0] for row in self.db.execute(
+                "SELECT id FROM jobs WHERE status = ? AND (heartbeat_at IS NULL OR heartbeat_at < ?) "
+                "AND attempts >= ?", (RUNNING, expired, self.max_attempts))]
+            self.db.execute("UPDATE jobs SET status = ?, started_at = NULL, heartbeat_at = NULL "
+                            "WHERE status = ? AND (heartbeat_at IS NULL OR heartbeat_at < ?) AND attempts < ?",
+                            (QUEUED, RUNNING, expired, self.max_attempts))
+        for job_id in abandoned:
+            self.finish(job_id, error=f"abandoned after {self.max_attempts} attempts")
+
+    # Store the JSON result of a job (or its error) and drop its image once no pending job needs it
+    def finish(self, job_id, result=None, error=None):
+        with self.lock, self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.execute("UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE id = ?",
+                            (FAILED if error is not None else DONE, result, error, time.time(), job_id))
+            image_hash = self.db.execute("SELECT image_hash FROM jobs WHERE id = ?", (job_id,)).fetchone()[0]
+            pending = self.db.execute("SELECT COUNT(*) FROM jobs WHERE image_hash = ? AND status IN (?, ?)",
+                                      (image_hash, *PENDING_STATUSES)).fetchone()[0]
+            # Under the lock, so a concurrent submission of the same image cannot lose it
+            if not pending:
+                self._remove_image(image_hash)
+
+    def get(self, job_id):
+        with self.lock:
+            row = self.db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return None if row is None else dict(row)
+
+    def counts(self):
+        with self.lock:
+            return dict(self.db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    # Forget finished jobs older than the retention period
+    def purge(self):
+        with self.lock:
+            self.db.execute("DELETE FROM jobs WHERE status IN (?, ?) AND finished_at < ?",
+                            (DONE, FAILED, time.time() - self.retention_seconds))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def _image_path(self, image_hash):
+        return os.path.join(self.image_dir, image_hash)
+
+    def _write_image(self, image_hash, image_data):
+        path = self._image_path(image_hash)
+        if os.path.exists(path):
+            return
+        # Write then rename so a crash never leaves a truncated image behind
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(image_data)
+        os.replace(tmp_path, path)
+
+    def _remove_image(self, image_hash):
+        try:
+            os.remove(self._image_path(image_hash))
+        except OSError:
+            pass
+
+def make_job_key(task, params, image_hash):
+    return hashlib.sha256(json.dumps([task, image_hash, params], sort_keys=True).encode()).hexdigest()
+
+
+class JobRunner:
+    # Pool of `workers` asyncio tasks taking jobs from a JobStore and running them with
+    # `handler(task, image_data, params)`, a coroutine returning the JSON bytes of the result. A
+    # saturated pipeline puts the job back in the queue for later; any other error fails the job.
+    # Store calls block on SQLite and the image files, so they run in `executor` (None: the loop's
+    # default executor). The lease of a running job is renewed every third of the store's lease.
+    def __init__(self, store, handler, workers=2, poll_interval=1.0, executor=None):
+        self.store = store
+        self.handler = handler
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.executor = executor
+        self.tasks = []
+        self.wakeup = None
+        self.waiters = {}
+
+    def start(self):
+        self.wakeup = asyncio.Event()
+        self.tasks = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    # Runs a blocking call, typically a JobStore method, in the executor
+    async def run(self, fn, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+
+    # Queue a job (JobStore.submit) and wake idle workers up without waiting for the next poll.
+    # Returns the job id, whether it was deduplicated and its current status.
+    async def submit(self, task, params, image_hash, image_data):
+        job_id, deduplicated = await self.run(self.store.submit, task, params, image_hash, image_data)
+        job = await self.run(self.store.get, job_id)
+        if self.wakeup is not None:
+            self.wakeup.set()
+        return job_id, deduplicated, job["status"]
+
+    # The job once it is finished, or as it is after `timeout` seconds (None if it does not exist).
+    # The store is also read again every poll_interval, for jobs run by another process.
+    async def wait(self, job_id, timeout):
+        # One event per waiting request, registered before the status is read so a job finishing in
+        # between still wakes it, and dropped when the request returns, finished or not
+        event = asyncio.Event()
+        self.waiters.setdefault(job_id, set()).add(event)
+        deadline = asyncio.get_running_loop().time() + timeout
+        try:
+            while True:
+                job = await self.run(self.store.get, job_id)
+                remaining = deadline - asyncio.get_running_loop().time()
+                if job is None or job["status"] not in PENDING_STATUSES or remaining <= 0:
+                    return job
+                try:
+                    await asyncio.wait_for(event.wait(), min(remaining, self.poll_interval))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            events = self.waiters.get(job_id)
+            if events is not None:
+                events.discard(event)
+                if not events:
+                    del self.waiters[job_id]
+
+    async def _run(self):
+        while True:
+            # Cleared before claiming, so a submission made while the queue is read still wakes a worker
+            self.wakeup.clear()
+            claimed = await self.run(self.store.claim)
+            if claimed is None:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            job_id, task, params, image_data = claimed
+            heartbeat = asyncio.create_task(self._heartbeat(job_id))
+            try:
+                result = await self.handler(task, image_data, params)
+            except Saturated as e:
+                await self.run(self.store.release, job_id)
+                await asyncio.sleep(e.retry_after)
+                continue
+            except asyncio.CancelledError:
+                # Shutting down: hand the job back now rather than when its lease expires
+                self.store.release(job_id)
+                raise
+            except Exception as e:
+                await self.run(self.store.finish, job_id, error=str(e))
+            else:
+                await self.run(self.store.finish, job_id, result=result.decode())
+            finally:
+                heartbeat.cancel()
+            for event in self.waiters.pop(job_id, ()):
+                event.set()
+
+    async def _heartbeat(self, job_id):
+        while True:
+            await asyncio.sleep(self.store.lease_seconds / 3)
+            await self.run(self.store.heartbeat, job_id)
@@ -0,0 +1,105 @@
+import bisect
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Instrumentation is on by default and can be turned off with GLASSFINDER_METRICS=0; the
+# Server-Timing response header is opt-in with GLASSFINDER_SERVER_TIMING=1
+enabled = os.environ.get("GLASSFINDER_METRICS", "1") != "0"
+server_timing_enabled = os.environ.get("GLASSFINDER_SERVER_TIMING", "0") == "1"
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Endpoint label and per-request stage durations of the request being handled
+current_endpoint = contextvars.ContextVar("current_endpoint", default="")
+request_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+class Histogram:
+    # Cumulative-bucket histogram rendered in the Prometheus text exposition format
+    def __init__(self, name, help_text, buckets, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.label_names = label_names
+        self.series = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * len(self.buckets), 0, 0.0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += 1
+            series[2] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for label_values, (counts, count, total) in sorted(self.series.items()):
+                labels = ",".join(f'{name}="{value}"' for name, value in zip(self.label_names, label_values))
+                prefix = labels + "," if labels else ""
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+                lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {count}')
+                suffix = "{" + labels + "}" if labels else ""
+                lines.append(f"{self.name}_count{suffix} {count}")
+                lines.append(f"{self.name}_sum{suffix} {total}")
+        return "\n".join(lines)
+
+
+registry = []
+stage_seconds = Histogram("glassfinder_stage_seconds", "Duration of each processing stage",
+                          LATENCY_BUCKETS, ("endpoint", "stage"))
+queue_wait_seconds = Histogram("glassfinder_queue_wait_seconds", "Time spent waiting for a worker or batch",
+                               LATENCY_BUCKETS, ("queue",))
+batch_size = Histogram("glassfinder_inference_batch_size", "Images per Mask R-CNN forward pass",
+                       (1, 2, 4, 8, 16, 32))
+image_megapixels = Histogram("glassfinder_image_megapixels", "Size of the processed images",
+                             (0.3, 1, 2, 4, 8, 12, 16, 24, 50), ("endpoint",))
+detection_count = Histogram("glassfinder_detections", "Window detections returned per image",
+                            (0, 1, 2, 5, 10, 20, 50, 100), ("endpoint",))
+line_count = Histogram("glassfinder_hough_lines", "Hough segments fed to RANSAC per image",
+                       (10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 50000), ("endpoint",))
+
+def render():
+    return "\n".join(histogram.render() for histogram in registry) + "\n"
+
+# Record one stage duration for the current request (histogram and Server-Timing)
+def record_stage(name, seconds):
+    if not enabled:
+        return
+    stage_seconds.observe(seconds, current_endpoint.get(), name)
+    timings = request_timings.get()
+    if timings is not None:
+        timings.append((name, seconds))
+
+def record_stages(timings):
+    for name, seconds in timings.items():
+        record_stage(name, seconds)
+
+def observe(histogram, value):
+    if enabled:
+        histogram.observe(value, current_endpoint.get())
+
+@contextmanager
+def stage(name):
+    if not enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start)
+
+def format_server_timing(timings):
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings)
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The backend modules are imported by their flat names, as app.py does
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
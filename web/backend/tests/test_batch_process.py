@@ -0,0 +1,22 @@
+import json
+import subprocess
+import sys
+
+import cv2
+import numpy as np
+
+from conftest import BACKEND_DIR
+
+
+def test_blank_image_records_missing_vanishing_points(tmp_path):
+    # A blank image has no line segments, so no pass finds a vanishing point
+    cv2.imwrite(str(tmp_path / "blank.png"), np.full((240, 320, 3), 200, dtype=np.uint8))
+    output = tmp_path / "results.jsonl"
+    subprocess.run([sys.executable, "batch_process.py", str(tmp_path), "--output", str(output), "--no-predict",
+                    "--vp-workers", "1"], cwd=BACKEND_DIR, check=True, timeout=300)
+
+    records = [json.loads(line) for line in output.read_text().splitlines()]
+    assert len(records) == 1
+    assert "error" not in records[0]
+    assert records[0]["vanishing_points"] == [None, None, None]
+    assert (records[0]["height"], records[0]["width"]) == (240, 320)
@@ -0,0 +1,72 @@
+import asyncio
+import os
+import pickle
+
+import numpy as np
+
+from cache import ResultCache
+
+# A value whose footprint (estimate_size) is its array: 1000 bytes
+VALUE = np.zeros(1000, np.uint8)
+
+
+def test_memory_tier_evicts_the_least_recently_used_entry():
+    cache = ResultCache(max_memory_bytes=2500)
+    cache.put("a", VALUE)
+    cache.put("b", VALUE)
+    cache.get("a")  # "b" is now the least recently used
+    cache.put("c", VALUE)
+
+    assert list(cache.memory) == ["a", "c"]
+    assert cache.memory_bytes == 2000
+    assert cache.get("b") is None
+
+
+def test_memory_tier_skips_values_larger_than_the_bound():
+    cache = ResultCache(max_memory_bytes=500)
+    cache.put("a", VALUE)
+    assert cache.get("a") is None and cache.memory_bytes == 0
+
+
+def test_disk_tier_survives_a_new_cache_and_evicts_the_oldest_file(tmp_path):
+    size = len(pickle.dumps(VALUE, protocol=pickle.HIGHEST_PROTOCOL))
+    cache = ResultCache(0, str(tmp_path), max_disk_bytes=2 * size)
+    cache.put("a", VALUE)
+    cache.put("b", VALUE)
+    os.utime(cache._disk_path("a"), (0, 0))  # "a" is now the least recently used file
+    cache.put("c", VALUE)
+
+    assert cache.disk_bytes == 2 * size
+    reopened = ResultCache(0, str(tmp_path), max_disk_bytes=2 * size)
+    assert reopened.disk_bytes == 2 * size
+    assert reopened.get("a") is None
+    assert np.array_equal(reopened.get("b"), VALUE) and np.array_equal(reopened.get("c"), VALUE)
+
+
+def test_corrupt_disk_entry_is_a_miss_until_rewritten(tmp_path):
+    cache = ResultCache(0, str(tmp_path), max_disk_bytes=1 << 20)
+    cache.put("a", VALUE)
+    path = cache._disk_path("a")
+    with open(path, "r+b") as f:
+        f.truncate(10)
+    assert cache.get("a") is None
+    with open(path, "wb") as f:
+        f.write(b"not a pickle")
+    assert cache.get("a") is None
+
+    cache.put("a", VALUE)
+    assert np.array_equal(cache.get("a"), VALUE)
+
+
+def test_async_methods_read_back_through_the_disk_tier(tmp_path):
+    cache = ResultCache(1 << 20, str(tmp_path), max_disk_bytes=1 << 20)
+
+    async def scenario():
+        await cache.put_async("a", VALUE)
+        cache.clear()  # Only the disk entry is left
+        value = await cache.get_async("a")
+        return value, await cache.get_async("missing")
+
+    value, missing = asyncio.run(scenario())
+    assert np.array_equal(value, VALUE) and missing is None
+    assert "a" in cache.memory  # Promoted back to the memory tier
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from encoding import BINARY_ALIGNMENT, pack_arrays, rle_decode, rle_encode, unpack_arrays
+
+
+@pytest.mark.parametrize("mask", [
+    np.array([[0, 0, 1], [1, 1, 0]], dtype=bool),
+    np.array([[1, 1, 0], [0, 1, 1]], dtype=bool),  # Starts with mask pixels: leading empty zero run
+    np.zeros((3, 4), dtype=bool),
+    np.ones((3, 4), dtype=bool),
+    np.random.default_rng(0).random((17, 23)) > 0.5,
+])
+def test_rle_round_trip(mask):
+    runs = rle_encode(mask)
+    assert runs.dtype == np.uint32 and runs.sum() == mask.size
+    assert np.array_equal(rle_decode(runs, *mask.shape), mask)
+
+
+def test_rle_starts_with_a_run_of_zeros():
+    assert rle_encode(np.array([[1, 1, 0]], dtype=bool)).tolist() == [0, 2, 1]
+    assert rle_encode(np.zeros((0, 5), dtype=bool)).size == 0
+
+
+def test_pack_arrays_round_trip_with_aligned_arrays():
+    arrays = {
+        "odd": np.arange(3, dtype=np.uint8),  # Padded so the next array stays aligned
+        "scores": np.array([0.5, 0.25], dtype=np.float32),
+        "contours": np.arange(16, dtype=np.int32).reshape(2, 4, 2),
+        "big_endian": np.arange(3, dtype=">i8"),
+        "empty": np.zeros((0, 4), dtype=np.int32),
+    }
+    data = pack_arrays(arrays, {"count": 2})
+    meta, unpacked = unpack_arrays(data)
+
+    assert meta == {"count": 2}
+    assert list(unpacked) == list(arrays)
+    for name, array in arrays.items():
+        assert unpacked[name].shape == array.shape
+        assert np.array_equal(unpacked[name], array)
+    assert unpacked["big_endian"].dtype == np.dtype("<i8")
+    # Every array is a view of the body starting on an aligned byte
+    base = np.frombuffer(data, np.uint8).ctypes.data
+    assert all((array.ctypes.data - base) % BINARY_ALIGNMENT == 0 for array in unpacked.values() if array.size)
+
+
+def test_unpack_arrays_rejects_other_data():
+    with pytest.raises(ValueError):
+        unpack_arrays(b'{"predictions": []}')
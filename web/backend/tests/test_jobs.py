@@ -0,0 +1,114 @@
+import asyncio
+import os
+
+import pytest
+
+from jobs import DONE, FAILED, QUEUED, RUNNING, JobRunner, JobStore
+
+IMAGE = b"image bytes"
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = JobStore(str(tmp_path), lease_seconds=60, max_attempts=2)
+    yield store
+    store.close()
+
+
+def test_submit_deduplicates_the_same_task_image_and_params(store):
+    job_id, deduplicated = store.submit("predict", {"threshold": 0.5}, "hash", IMAGE)
+    assert not deduplicated
+    assert store.submit("predict", {"threshold": 0.5}, "hash", IMAGE) == (job_id, True)
+    assert store.submit("predict", {"threshold": 0.9}, "hash", IMAGE)[0] != job_id
+    assert store.submit("analyze", {"threshold": 0.5}, "hash", IMAGE)[0] != job_id
+
+
+def test_claim_and_finish_drop_the_image_once_no_job_needs_it(store):
+    job_id, _ = store.submit("predict", {}, "hash", IMAGE)
+    claimed_id, task, params, image_data = store.claim()
+    assert (claimed_id, task, params, image_data) == (job_id, "predict", {}, IMAGE)
+    assert store.claim() is None
+
+    store.finish(job_id, result='{"predictions": []}')
+    job = store.get(job_id)
+    assert (job["status"], job["result"], job["attempts"]) == (DONE, '{"predictions": []}', 1)
+    assert os.listdir(store.image_dir) == []
+
+
+def test_failed_job_is_queued_again_on_resubmission(store):
+    job_id, _ = store.submit("predict", {}, "hash", IMAGE)
+    store.claim()
+    store.finish(job_id, error="boom")
+    assert store.get(job_id)["status"] == FAILED
+
+    assert store.submit("predict", {}, "hash", IMAGE) == (job_id, True)
+    job = store.get(job_id)
+    assert (job["status"], job["error"]) == (QUEUED, None)
+    assert store.claim()[3] == IMAGE
+
+
+def test_opening_the_store_keeps_jobs_with_a_live_lease(store, tmp_path):
+    job_id, _ = store.submit("predict", {}, "hash", IMAGE)
+    store.claim()
+
+    # Another worker process opening the same directory
+    other = JobStore(str(tmp_path), lease_seconds=60)
+    try:
+        assert other.get(job_id)["status"] == RUNNING
+        assert other.claim() is None
+    finally:
+        other.close()
+
+
+def test_expired_lease_is_requeued_then_failed_after_max_attempts(store):
+    job_id, _ = store.submit("predict", {}, "hash", IMAGE)
+    store.claim()
+    store.lease_seconds = -1  # Every lease is now expired
+
+    assert store.claim()[0] == job_id  # Requeued by recover(), then claimed again
+    assert store.get(job_id)["attempts"] == 2
+    store.recover()
+    job = store.get(job_id)
+    assert (job["status"], job["error"]) == (FAILED, "abandoned after 2 attempts")
+    assert os.listdir(store.image_dir) == []
+
+
+def test_release_does_not_count_the_attempt(store):
+    job_id, _ = store.submit("predict", {}, "hash", IMAGE)
+    store.claim()
+    store.release(job_id)
+    job = store.get(job_id)
+    assert (job["status"], job["attempts"]) == (QUEUED, 0)
+
+
+def test_wait_returns_as_soon_as_a_worker_finishes_the_job(store):
+    async def handler(task, image_data, params):
+        return b'{"predictions": []}'
+
+    async def scenario():
+        # A poll interval far above the wait timeout: only the wakeups can get the job done in time
+        runner = JobRunner(store, handler, workers=1, poll_interval=60)
+        runner.start()
+        try:
+            await asyncio.sleep(0.1)  # The worker is now idle, waiting for a wakeup
+            job_id, _, _ = await runner.submit("predict", {}, "hash", IMAGE)
+            return await runner.wait(job_id, timeout=5)
+        finally:
+            await runner.stop()
+
+    job = asyncio.run(scenario())
+    assert (job["status"], job["result"]) == (DONE, '{"predictions": []}')
+
+
+def test_wait_sees_a_job_finished_by_another_process(store):
+    async def scenario():
+        runner = JobRunner(store, None, poll_interval=0.05)
+        job_id, _, _ = await runner.submit("predict", {}, "hash", IMAGE)
+        store.claim()
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.1, lambda: store.finish(job_id, result="{}"))
+        job = await runner.wait(job_id, timeout=5)
+        assert runner.waiters == {}
+        return job
+
+    assert asyncio.run(scenario())["status"] == DONE
@@ -0,0 +1,41 @@
+import os
+import threading
+from collections import Counter
+
+import pytest
+
+from conftest import BACKEND_DIR
+from vp_detection import Cancelled, VanishingPointPipeline, get_required_iterations
+
+# About a hundred line segments, so a whole pass of 3000 hypotheses fits in one unbounded chunk
+FACADE = os.path.join(BACKEND_DIR, "..", "..", "maskrcnn", "images", "01353504487D1000005.JPG")
+
+
+def test_progress_reports_hypotheses_within_a_pass():
+    events = []
+    VanishingPointPipeline(iterations=3000, seed=0).detect(FACADE, progress=events.append)
+
+    hypotheses = Counter(event["pass"] for event in events if event["event"] == "hypothesis")
+    assert max(hypotheses.values()) >= 2
+    # Each intermediate event comes before the search has drawn all its samples
+    assert any(event["iterations"] < 3000 for event in events if event["event"] == "hypothesis")
+    assert [event["pass"] for event in events if event["event"] == "vanishing_point"] == [1, 2, 3]
+
+
+def test_cancel_stops_during_the_first_pass():
+    cancel = threading.Event()
+    events = []
+
+    def progress(event):
+        events.append(event)
+        cancel.set()
+
+    with pytest.raises(Cancelled):
+        VanishingPointPipeline(iterations=3000, seed=0).detect(FACADE, progress=progress, cancel=cancel)
+    assert [event["event"] for event in events] == ["hypothesis"]
+
+
+def test_required_iterations_without_early_stop_at_full_confidence():
+    assert get_required_iterations(0.3, 0.99) == 49
+    assert get_required_iterations(0.3, 1.0) == float("inf")
+    assert get_required_iterations(1.0, 0.99) == 0
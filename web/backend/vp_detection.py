@@ -1,22 +1,91 @@
 from skimage import io, feature, color, transform
 import numpy as np
+import os
 import tempfile
-import matplotlib.pyplot as plt
-from matplotlib import cm
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from imaging import decode_image
 
+# RANSAC strategies of get_vp_inliers: three sequential passes, or one shared hypothesis pool
+SOLVERS = ("sequential", "joint")
+
+
+class Cancelled(Exception):
+    # Raised inside a VP computation once its cancel event is set
+    pass
+
+class StageCache:
+    # Memoizes the upstream VP stages (decoded image, grayscale, Canny edges, Hough lines) for the
+    # max_images most recently used images, so a call that only changes RANSAC parameters skips them
+    def __init__(self, max_images=4):
+        self.max_images = max_images
+        self.images = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_or_compute(self, image_key, stage, compute):
+        if image_key is None or self.max_images <= 0:
+            return compute()
+        with self.lock:
+            stages = self.images.get(image_key)
+            if stages is not None:
+                self.images.move_to_end(image_key)
+                if stage in stages:
+                    return stages[stage]
+        value = compute()
+        with self.lock:
+            stages = self.images.setdefault(image_key, {})
+            stages[stage] = value
+            self.images.move_to_end(image_key)
+            while len(self.images) > self.max_images:
+                self.images.popitem(last=False)
+        return value
+
+# One cache per process, so each VP worker process keeps its own recent images
+stage_cache = StageCache(int(os.environ.get("GLASSFINDER_VP_STAGE_CACHE_IMAGES", 4)))
+
+class Workspace:
+    # Scratch arrays reused from one call to the next: get() returns a view of the buffer kept under
+    # `name`, reallocated only when a larger size or another dtype is requested. Not thread-safe.
+    def __init__(self):
+        self.buffers = {}
+
+    def get(self, name, shape, dtype=float):
+        size = int(np.prod(shape))
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.dtype != dtype or buffer.size < size:
+            buffer = self.buffers[name] = np.empty(size, dtype=dtype)
+        return buffer[:size].reshape(shape)
+
+# Accepts a file path or an image already decoded to an array
 def read_image(path):
+    if isinstance(path, np.ndarray):
+        return path
     image = io.imread(path)
     return image
 
+def get_grayscale(image):
+    if image.ndim == 3:
+        return color.rgb2gray(image)
+    return image
+
 def get_canny_edges(image, sigma):
-    edges = feature.canny(color.rgb2gray(image), sigma=sigma)
+    edges = feature.canny(get_grayscale(image), sigma=sigma)
     return edges
 
-def get_hough_lines(edges, line_length, line_gap):
-    lines = transform.probabilistic_hough_line(edges, line_length=line_length, line_gap=line_gap)
-    return np.asarray(lines)
+# rng seeds the random pixel order of the probabilistic Hough transform for reproducible lines
+def get_hough_lines(edges, line_length, line_gap, rng=None):
+    lines = transform.probabilistic_hough_line(edges, line_length=line_length, line_gap=line_gap, rng=rng)
+    # An image without segments still gives a (0, 2, 2) array
+    return np.asarray(lines).reshape(-1, 2, 2)
 
-def run_line_ransac(lines, ransac_iter, ransac_angle_thresh, ignore_pts=None):
+# weights gives each line its vote, e.g. its length; by default every line counts once
+# rng is a numpy Generator or RandomState drawing the samples; by default the global numpy one
+def run_line_ransac(lines, ransac_iter, ransac_angle_thresh, ignore_pts=None, confidence=None, min_iterations=0,
+                    info=None, weights=None, rng=None):
     best_vote_count = 0
     best_inliers = None
     best_hypothesis = None
@@ -25,8 +94,17 @@ def run_line_ransac(lines, ransac_iter, ransac_angle_thresh, ignore_pts=None):
         lines_to_chose = np.arange(lines.shape[0])
     else:
         lines_to_chose = np.where(ignore_pts==0)[0]
-    for iter_count in range(ransac_iter):
-        idx1, idx2 = np.random.choice(lines_to_chose, 2, replace=False)
+    if info is not None:
+        info['iterations'] = 0
+    if lines_to_chose.shape[0] < 2:
+        return None, None
+    if rng is None:
+        rng = np.random
+    required_iter = ransac_iter
+    iter_count = 0
+    while iter_count < min(ransac_iter, max(min_iterations, required_iter)):
+        iter_count += 1
+        idx1, idx2 = rng.choice(lines_to_chose, 2, replace=False)
         l1 = np.cross(np.append(lines[idx1][1], 1), np.append(lines[idx1][0], 1))
         l2 = np.cross(np.append(lines[idx2][1], 1), np.append(lines[idx2][0], 1))
 
@@ -34,12 +112,205 @@ def run_line_ransac(lines, ransac_iter, ransac_angle_thresh, ignore_pts=None):
         if current_hypothesis[-1] == 0:
             continue
         inliers, vote_count = calculate_metric_angle(current_hypothesis, lines, ignore_pts, ransac_angle_thresh)
+        if weights is not None:
+            vote_count = weights[inliers].sum()
         if vote_count > best_vote_count:
             best_vote_count = vote_count
             best_hypothesis = current_hypothesis
             best_inliers = inliers
+            if confidence is not None:
+                required_iter = get_required_iterations(inliers.sum() / lines_to_chose.shape[0], confidence)
+    if info is not None:
+        info['iterations'] = iter_count
+    return best_hypothesis, best_inliers
+
+def get_required_iterations(inlier_ratio, confidence):
+    # Number of two-line samples needed to draw at least one all-inlier pair with the given confidence.
+    # Certainty (confidence >= 1) is never reached early, so the search runs up to its iteration cap.
+    pair_ratio = inlier_ratio ** 2
+    if pair_ratio >= 1:
+        return 0
+    if pair_ratio <= 0 or confidence >= 1:
+        return np.inf
+    return int(np.ceil(np.log(1 - confidence) / np.log(1 - pair_ratio)))
+
+def get_homogeneous_lines(lines):
+    # Homogeneous line through both end points of each segment, same orientation as run_line_ransac
+    ones = np.ones((lines.shape[0], 1), dtype=lines.dtype)
+    return np.cross(np.hstack([lines[:, 1], ones]), np.hstack([lines[:, 0], ones]))
+
+# ransac_iter pairs of distinct indices below count, drawn with rng as in run_line_ransac
+def sample_line_pairs(count, ransac_iter, rng=None):
+    if rng is None:
+        rng = np.random
+    integers = rng.integers if hasattr(rng, "integers") else rng.randint
+    first = integers(0, count, size=ransac_iter)
+    second = integers(0, count - 1, size=ransac_iter)
+    second += second >= first
+    return first, second
+
+def run_line_ransac_batched(lines, ransac_iter, ransac_angle_thresh, ignore_pts=None, confidence=None,
+                            min_iterations=0, info=None, chunk_size=None, max_chunk_elements=1 << 20,
+                            adaptive_chunk_size=100, weights=None, progress=None, cancel=None, rng=None,
+                            workspace=None, stream_chunk_size=250):
+    # Vectorized equivalent of run_line_ransac: all hypothesis pairs are sampled up front and scored
+    # against every line in chunks of hypotheses, so memory stays bounded by max_chunk_elements.
+    # With a confidence level the search stops after the first chunk where enough samples were drawn.
+    # progress(samples drawn, best hypothesis, votes) is called whenever the best hypothesis improves,
+    # and the search raises Cancelled between chunks once the `cancel` event is set; with either, chunks
+    # hold at most stream_chunk_size hypotheses so a pass reports and checks several times. With a
+    # Workspace the chunk matrices reuse its buffers instead of being allocated for every chunk.
+    if ignore_pts is None:
+        ignore_pts = np.zeros((lines.shape[0])).astype('bool')
+        lines_to_chose = np.arange(lines.shape[0])
+    else:
+        lines_to_chose = np.where(ignore_pts==0)[0]
+    if info is not None:
+        info['iterations'] = 0
+    if lines_to_chose.shape[0] < 2 or ransac_iter <= 0:
+        return None, None
+
+    # Sample every pair of distinct lines at once
+    first, second = sample_line_pairs(lines_to_chose.shape[0], ransac_iter, rng)
+    homogeneous_lines = get_homogeneous_lines(lines)
+    hypotheses = np.cross(homogeneous_lines[lines_to_chose[first]], homogeneous_lines[lines_to_chose[second]])
+    sample_index = np.nonzero(hypotheses[:, -1] != 0)[0]
+    hypotheses = hypotheses[sample_index]
+
+    origins = lines[:, 0].astype(float)
+    directions = (lines[:, 1] - lines[:, 0]).astype(float)
+    directions_norm = np.linalg.norm(directions, axis=1)
+    cos_thresh = np.cos(ransac_angle_thresh * np.pi / 180)
+    if chunk_size is None:
+        chunk_size = max(1, max_chunk_elements // max(1, lines.shape[0]))
+    if confidence is not None:
+        chunk_size = min(chunk_size, adaptive_chunk_size)
+    if progress is not None or cancel is not None:
+        chunk_size = min(chunk_size, stream_chunk_size)
+
+    best_vote_count = 0
+    best_inliers = None
+    best_hypothesis = None
+    required_iter = ransac_iter
+    iter_count = ransac_iter
+    for start in range(0, hypotheses.shape[0], chunk_size):
+        if cancel is not None and cancel.is_set():
+            raise Cancelled()
+        chunk = hypotheses[start:start + chunk_size]
+        inliers = get_inlier_matrix(chunk, origins, directions, directions_norm, cos_thresh, workspace)
+        inliers[:, ignore_pts] = False
+        vote_counts = inliers.sum(axis=1) if weights is None else inliers @ weights
+        best_in_chunk = np.argmax(vote_counts)
+        # Samples drawn so far, including degenerate pairs skipped before scoring
+        drawn = sample_index[start + chunk.shape[0] - 1] + 1
+        if vote_counts[best_in_chunk] > best_vote_count:
+            best_vote_count = vote_counts[best_in_chunk]
+            best_hypothesis = chunk[best_in_chunk]
+            # Copied, since the next chunk may overwrite the workspace buffer
+            best_inliers = inliers[best_in_chunk].copy()
+            if confidence is not None:
+                # Samples are drawn uniformly, so the stopping rule uses the inlier count, not the votes
+                required_iter = get_required_iterations(best_inliers.sum() / lines_to_chose.shape[0], confidence)
+            if progress is not None:
+                progress(int(drawn), best_hypothesis, float(best_vote_count))
+        if confidence is not None and drawn >= max(min_iterations, required_iter):
+            iter_count = drawn
+            break
+    if info is not None:
+        info['iterations'] = int(iter_count)
     return best_hypothesis, best_inliers
 
+def run_multi_vp_ransac(lines, ransac_iter, ransac_angle_thresh, vp_count=3, weights=None, info=None, workers=None,
+                        chunk_size=None, max_chunk_elements=1 << 20, cancel=None, rng=None, stream_chunk_size=250):
+    # Joint alternative to vp_count sequential RANSAC passes: one pool of ransac_iter hypotheses is
+    # drawn from all lines and scored against every line once, in chunks spread over worker threads
+    # (numpy releases the GIL). The inlier matrix is kept bit-packed, and each VP is then the
+    # hypothesis with the most votes among the lines not already claimed by the previous ones, so
+    # the later VPs cost a pass over the bits instead of a new RANSAC run. Returns the hypotheses and
+    # inlier masks of the vp_count VPs, with None for a VP when no hypothesis gets any vote. With a
+    # `cancel` event, chunks hold at most stream_chunk_size hypotheses so the event is checked often.
+    hypothesis_list = [None] * vp_count
+    inlier_lines_list = [np.zeros(lines.shape[0], dtype=bool) for _ in range(vp_count)]
+    if info is not None:
+        info['iterations'] = [0] * vp_count
+    if lines.shape[0] < 2 or ransac_iter <= 0:
+        return hypothesis_list, inlier_lines_list
+
+    first, second = sample_line_pairs(lines.shape[0], ransac_iter, rng)
+    homogeneous_lines = get_homogeneous_lines(lines)
+    hypotheses = np.cross(homogeneous_lines[first], homogeneous_lines[second])
+    hypotheses = hypotheses[hypotheses[:, -1] != 0]
+    if info is not None:
+        info['iterations'] = [ransac_iter] * vp_count
+    if hypotheses.shape[0] == 0:
+        return hypothesis_list, inlier_lines_list
+
+    origins = lines[:, 0].astype(float)
+    directions = (lines[:, 1] - lines[:, 0]).astype(float)
+    directions_norm = np.linalg.norm(directions, axis=1)
+    cos_thresh = np.cos(ransac_angle_thresh * np.pi / 180)
+    if chunk_size is None:
+        chunk_size = max(1, max_chunk_elements // lines.shape[0])
+    if cancel is not None:
+        chunk_size = min(chunk_size, stream_chunk_size)
+    if workers is None:
+        workers = min(4, os.cpu_count() or 1)
+    # At least one chunk per worker
+    chunk_size = max(1, min(chunk_size, -(-hypotheses.shape[0] // workers)))
+    starts = range(0, hypotheses.shape[0], chunk_size)
+
+    def score_chunk(start):
+        if cancel is not None and cancel.is_set():
+            raise Cancelled()
+        inliers = get_inlier_matrix(hypotheses[start:start + chunk_size], origins, directions, directions_norm,
+                                    cos_thresh)
+        return np.packbits(inliers, axis=1)
+
+    pool = ThreadPoolExecutor(max_workers=workers) if workers > 1 and len(starts) > 1 else None
+    map_chunks = map if pool is None else pool.map
+    try:
+        packed = np.concatenate(list(map_chunks(score_chunk, starts)))
+        line_weights = np.ones(lines.shape[0]) if weights is None else np.asarray(weights, dtype=float)
+        available = np.ones(lines.shape[0], dtype=bool)
+        for vp_index in range(vp_count):
+            # Votes of every hypothesis over the lines still available
+            remaining = np.where(available, line_weights, 0)
+            votes = np.concatenate(list(map_chunks(lambda start: np.unpackbits(
+                packed[start:start + chunk_size], axis=1, count=lines.shape[0]) @ remaining, starts)))
+            best = np.argmax(votes)
+            if votes[best] <= 0:
+                break
+            inliers = np.unpackbits(packed[best], count=lines.shape[0]).astype(bool) & available
+            hypothesis_list[vp_index] = hypotheses[best]
+            inlier_lines_list[vp_index] = inliers
+            available &= ~inliers
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return hypothesis_list, inlier_lines_list
+
+def get_inlier_matrix(hypotheses, origins, directions, directions_norm, cos_thresh, workspace=None):
+    # Same test as calculate_metric_angle for a whole chunk of hypotheses: |cos(theta)| > cos(thresh)
+    # is equivalent to theta < thresh and avoids the arccos over the full matrix. Unlike the loop, lines
+    # passing exactly through the hypothesis are counted (there |cos| rounds above 1 and arccos gives NaN).
+    # With a Workspace the result is a view of its "inliers" buffer, valid until the next call.
+    shape = (hypotheses.shape[0], origins.shape[0])
+
+    def out(name, dtype=float):
+        return None if workspace is None else workspace.get(name, shape, dtype)
+
+    vp = hypotheses[:, :2] / hypotheses[:, 2:]
+    dx = np.subtract(vp[:, 0:1], origins[:, 0], out=out("dx"))
+    dy = np.subtract(vp[:, 1:2], origins[:, 1], out=out("dy"))
+    magnitude = np.hypot(dx, dy, out=out("magnitude"))
+    magnitude *= directions_norm
+    magnitude *= cos_thresh
+    dx *= directions[:, 0]
+    dy *= directions[:, 1]
+    dx += dy
+    dot = np.abs(dx, out=dx)
+    return np.greater(dot, magnitude, out=out("inliers", bool))
+
 def calculate_metric_angle(current_hypothesis, lines, ignore_pts, ransac_angle_thresh):
     current_hypothesis = current_hypothesis / current_hypothesis[-1]
     hypothesis_vp_direction = current_hypothesis[:2] - lines[:,0]
@@ -52,24 +323,390 @@ def calculate_metric_angle(current_hypothesis, lines, ignore_pts, ransac_angle_t
     inliers[ignore_pts] = False
     return inliers, inliers.sum()
 
-def get_vp_inliers(image_path, sigma, iterations, line_len, line_gap, threshold):
-    image = read_image(image_path)
-    edges = get_canny_edges(image, sigma=sigma)
-    lines = get_hough_lines(edges, line_length=line_len, line_gap=line_gap)
-
-    best_hypothesis_1, best_inliers_1 = run_line_ransac(lines, iterations, threshold)
-    ignore_pts = best_inliers_1
-    best_hypothesis_2, best_inliers_2 = run_line_ransac(lines, iterations, threshold, ignore_pts=ignore_pts)
-    ignore_pts = np.logical_or(best_inliers_1, best_inliers_2)
-    best_hypothesis_3, best_inliers_3 = run_line_ransac(lines, iterations, threshold, ignore_pts=ignore_pts)
-    inlier_lines_list = [best_inliers_1, best_inliers_2, best_inliers_3]
-    best_hypothesis_1 = best_hypothesis_1 / best_hypothesis_1[-1]
-    best_hypothesis_2 = best_hypothesis_2 / best_hypothesis_2[-1]
-    best_hypothesis_3 = best_hypothesis_3 / best_hypothesis_3[-1]
-    hypothesis_list = [best_hypothesis_1, best_hypothesis_2, best_hypothesis_3]
+def get_line_geometry(lines):
+    # Midpoint, unit direction and length of each segment
+    lines = lines.reshape(-1, 2, 2).astype(float)
+    directions = lines[:, 1] - lines[:, 0]
+    lengths = np.linalg.norm(directions, axis=1)
+    directions /= np.maximum(lengths, 1e-9)[:, None]
+    return lines.mean(axis=1), directions, lengths
+
+def merge_collinear_lines(lines, merge_angle=1.0, merge_distance=2.0, max_chunk_elements=1 << 22):
+    # Fragments of the same edge returned separately by the probabilistic Hough transform are joined:
+    # segments within merge_angle degrees of each other, whose end points lie within merge_distance
+    # pixels of the other's supporting line and whose extents overlap (or leave a gap shorter than
+    # merge_distance) form one group, replaced by the segment spanning the group along its mean direction
+    lines = lines.reshape(-1, 2, 2).astype(float)
+    if lines.shape[0] < 2:
+        return lines
+    midpoints, directions, lengths = get_line_geometry(lines)
+    cos_angle = np.cos(merge_angle * np.pi / 180)
+    # Near-parallel pairs are filtered chunk by chunk, so only actual merge candidates accumulate:
+    # on facades a large share of all pairs is near-parallel
+    rows, cols = [], []
+    chunk_size = max(1, max_chunk_elements // lines.shape[0])
+    for start in range(0, lines.shape[0], chunk_size):
+        row, col = np.nonzero(np.abs(directions[start:start + chunk_size] @ directions.T) > cos_angle)
+        row += start
+        # End points of each near-parallel segment in the frame of the reference segment of the pair
+        d = directions[row]
+        offsets = lines[col] - midpoints[row][:, None, :]
+        along = offsets[..., 0] * d[:, None, 0] + offsets[..., 1] * d[:, None, 1]
+        across = np.abs(offsets[..., 0] * d[:, None, 1] - offsets[..., 1] * d[:, None, 0])
+        half = lengths[row] / 2 + merge_distance
+        keep = (across < merge_distance).all(axis=1) & (along.max(axis=1) > -half) & (along.min(axis=1) < half)
+        rows.append(row[keep])
+        cols.append(col[keep])
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    graph = coo_matrix((np.ones(rows.shape[0], dtype=bool), (rows, cols)), shape=(lines.shape[0],) * 2)
+    group_count, groups = connected_components(graph, directed=False)
+    if group_count == lines.shape[0]:
+        return lines
+
+    order = np.argsort(groups, kind="stable")
+    bounds = np.searchsorted(groups[order], np.arange(group_count + 1))
+    merged = lines[order[bounds[:-1]]]
+    for group in np.nonzero(np.diff(bounds) > 1)[0]:
+        members = order[bounds[group]:bounds[group + 1]]
+        # Length-weighted mean orientation, averaged on doubled angles so opposite directions agree
+        weight = lengths[members]
+        angle = np.arctan2(directions[members, 1], directions[members, 0])
+        mean_angle = np.arctan2((weight * np.sin(2 * angle)).sum(), (weight * np.cos(2 * angle)).sum()) / 2
+        direction = np.array([np.cos(mean_angle), np.sin(mean_angle)])
+        center = (weight[:, None] * midpoints[members]).sum(axis=0) / weight.sum()
+        projection = (lines[members] - center) @ direction
+        merged[group] = [center + projection.min() * direction, center + projection.max() * direction]
+    return merged
+
+def reduce_lines(lines, merge_angle=1.0, merge_distance=2.0, min_length_quantile=0.25, max_lines=500):
+    # Line set handed to RANSAC: collinear fragments merged, segments shorter than the given length
+    # quantile dropped, then at most max_lines of the longest kept. Returns the lines and their lengths,
+    # which serve as RANSAC votes so a long edge outweighs the clutter of short ones
+    if merge_angle is not None and merge_angle > 0:
+        lines = merge_collinear_lines(lines, merge_angle=merge_angle, merge_distance=merge_distance)
+    else:
+        lines = lines.reshape(-1, 2, 2).astype(float)
+    _, _, lengths = get_line_geometry(lines)
+    if min_length_quantile and lines.shape[0]:
+        keep = lengths >= np.quantile(lengths, min_length_quantile)
+        lines, lengths = lines[keep], lengths[keep]
+    if max_lines is not None and lines.shape[0] > max_lines:
+        keep = np.sort(np.argsort(-lengths, kind="stable")[:max_lines])
+        lines, lengths = lines[keep], lengths[keep]
+    return lines, lengths
+
+# Run compute() and store its duration in seconds under name
+def timed(timings, name, compute):
+    start = time.perf_counter()
+    value = compute()
+    timings[name] = time.perf_counter() - start
+    return value
+
+def get_vp_inliers(image_path, sigma, iterations, line_len, line_gap, threshold, batched=True, confidence=None,
+                   min_iterations=0, info=None, stage_cache=None, image_key=None, line_reduction=None,
+                   solver="sequential", workers=None, progress=None, cancel=None, rng=None, workspace=None):
+    # With a stage cache and a key identifying the image content, upstream stages are reused
+    # from previous calls that shared their parameters. line_reduction holds reduce_lines arguments
+    # ({} for the defaults); the reduced lines then vote with their length. solver="joint" replaces
+    # the three sequential RANSAC passes with run_multi_vp_ransac over `workers` threads.
+    # progress and cancel stream the RANSAC search (see run_sequential_passes). rng draws the Hough
+    # and RANSAC samples and workspace holds the RANSAC scratch buffers (see VanishingPointPipeline)
+    if stage_cache is None:
+        stage_cache = StageCache(max_images=0)
+    timings = {}
+    image = stage_cache.get_or_compute(image_key, "image", lambda: read_image(image_path))
+    gray = timed(timings, "grayscale", lambda: stage_cache.get_or_compute(image_key, "gray",
+                                                                         lambda: get_grayscale(image)))
+    edges = timed(timings, "canny", lambda: stage_cache.get_or_compute(
+        image_key, ("canny", sigma), lambda: get_canny_edges(gray, sigma=sigma)))
+    lines = timed(timings, "hough", lambda: stage_cache.get_or_compute(
+        image_key, ("hough", sigma, line_len, line_gap),
+        lambda: get_hough_lines(edges, line_length=line_len, line_gap=line_gap, rng=rng)))
+    line_count = int(lines.shape[0])
+    weights = None
+    if line_reduction is not None:
+        lines, weights = timed(timings, "line_reduction", lambda: reduce_lines(lines, **line_reduction))
+
+    if solver not in SOLVERS:
+        raise ValueError(f"unknown VP solver: {solver}")
+    if solver == "joint":
+        # All three VPs from one shared hypothesis pool; confidence-based stopping does not apply
+        joint_info = {}
+        hypothesis_list, inlier_lines_list = timed(timings, "ransac_joint", lambda: run_multi_vp_ransac(
+            lines, iterations, threshold, weights=weights, info=joint_info, workers=workers, cancel=cancel, rng=rng))
+        iterations_used = joint_info['iterations']
+        if progress is not None:
+            for pass_index, (hypothesis, inliers) in enumerate(zip(hypothesis_list, inlier_lines_list)):
+                report_pass(progress, pass_index + 1, hypothesis, inliers, iterations)
+    else:
+        hypothesis_list, inlier_lines_list, iterations_used = run_sequential_passes(
+            lines, iterations, threshold, timings, batched=batched, confidence=confidence,
+            min_iterations=min_iterations, weights=weights, progress=progress, cancel=cancel, rng=rng,
+            workspace=workspace)
+    if info is not None:
+        info['iterations'] = iterations_used
+        info['lines'] = line_count
+        if line_reduction is not None:
+            info['reduced_lines'] = int(lines.shape[0])
+        info.setdefault('timings', {}).update(timings)
+    hypothesis_list = [None if hypothesis is None else hypothesis / hypothesis[-1] for hypothesis in hypothesis_list]
     return inlier_lines_list, hypothesis_list, image, edges, lines
 
+def run_sequential_passes(lines, iterations, threshold, timings, batched=True, confidence=None, min_iterations=0,
+                          weights=None, progress=None, cancel=None, rng=None, workspace=None):
+    # batched=False keeps the original per-iteration loop for comparison. With a confidence level each
+    # pass stops early, between min_iterations and iterations, and the samples used are returned.
+    # progress receives the events of report_pass and report_hypothesis as the passes run; once the
+    # `cancel` event is set, Cancelled is raised before the next pass or hypothesis chunk. The
+    # per-iteration loop only reports finished passes.
+    ransac = run_line_ransac_batched if batched else run_line_ransac
+    hypothesis_list, inlier_lines_list, iterations_used = [], [], []
+    ignore_pts = np.zeros(lines.shape[0], dtype=bool)
+    for pass_index in range(3):
+        if cancel is not None and cancel.is_set():
+            raise Cancelled()
+        pass_info = {}
+        batched_options = {"progress": report_hypothesis(progress, pass_index + 1), "cancel": cancel,
+                           "workspace": workspace} if batched else {}
+        hypothesis, inliers = timed(timings, f"ransac_pass_{pass_index + 1}", lambda: ransac(
+            lines, iterations, threshold, ignore_pts=ignore_pts, confidence=confidence,
+            min_iterations=min_iterations, info=pass_info, weights=weights, rng=rng, **batched_options))
+        # A pass left with fewer than two lines finds no VP; its lines stay available to the next pass
+        if inliers is None:
+            inliers = np.zeros(lines.shape[0], dtype=bool)
+        ignore_pts = np.logical_or(ignore_pts, inliers)
+        hypothesis_list.append(hypothesis)
+        inlier_lines_list.append(inliers)
+        iterations_used.append(pass_info['iterations'])
+        if progress is not None:
+            report_pass(progress, pass_index + 1, hypothesis, inliers, pass_info['iterations'])
+    return hypothesis_list, inlier_lines_list, iterations_used
+
+# Progress events of a streamed VP search. "hypothesis" events give the best hypothesis of a running
+# pass whenever it improves, with its votes and the samples drawn so far; "vanishing_point" events
+# give the result of a finished pass (vanishing_point is None when the pass found none). Vanishing
+# points are normalized homogeneous points in the pixels of the processed image.
+def report_hypothesis(progress, pass_number, **extra):
+    if progress is None:
+        return None
+    def report(drawn, hypothesis, votes):
+        progress({"event": "hypothesis", "pass": pass_number, "vanishing_point": hypothesis / hypothesis[-1],
+                  "votes": votes, "iterations": drawn, **extra})
+    return report
+
+def report_pass(progress, pass_number, hypothesis, inliers, iterations, **extra):
+    progress({"event": "vanishing_point", "pass": pass_number,
+              "vanishing_point": None if hypothesis is None else hypothesis / hypothesis[-1],
+              "inliers": int(np.count_nonzero(inliers)), "iterations": int(iterations), **extra})
+
+# Hough segments of the grayscale image downscaled by an integer factor, with Canny sigma and Hough
+# lengths scaled down too. Segments are returned in full-resolution pixel coordinates.
+def get_level_lines(gray, factor, sigma, line_len, line_gap, timings, stage_cache=None, image_key=None, rng=None):
+    if stage_cache is None:
+        stage_cache = StageCache(max_images=0)
+    if factor == 1:
+        level = gray
+    else:
+        height, width = gray.shape[0] - gray.shape[0] % factor, gray.shape[1] - gray.shape[1] % factor
+        level = timed(timings, f"downscale_x{factor}", lambda: stage_cache.get_or_compute(
+            image_key, ("level", factor),
+            lambda: transform.downscale_local_mean(gray[:height, :width], (factor, factor))))
+    level_sigma = max(1.0, sigma / factor)
+    level_len = max(3, int(round(line_len / factor)))
+    level_gap = max(1, int(round(line_gap / factor)))
+    edges = timed(timings, f"canny_x{factor}", lambda: stage_cache.get_or_compute(
+        image_key, ("canny", level_sigma, factor), lambda: get_canny_edges(level, sigma=level_sigma)))
+    lines = timed(timings, f"hough_x{factor}", lambda: stage_cache.get_or_compute(
+        image_key, ("hough", level_sigma, level_len, level_gap, factor),
+        lambda: get_hough_lines(edges, line_length=level_len, line_gap=level_gap, rng=rng)))
+    lines = lines.reshape(-1, 2, 2)
+    if factor != 1:
+        lines = (lines + 0.5) * factor - 0.5  # Centre of the averaged pixel block
+    return edges, lines
+
+# Coarse-to-fine search: the three vanishing points are found on the image downscaled by the first
+# (largest) factor, then each level refines them with RANSAC restricted to the lines within
+# refine_threshold degrees of the previous estimate, so fine levels only score a fraction of their
+# lines. Returns the same values as get_vp_inliers, for the last level, in full-resolution pixels.
+# The last factor sets the resolution of the final estimate: the default (4, 2) stops at half
+# resolution, and (4, 2, 1) refines at full resolution at the cost of full-size Canny and Hough.
+def get_vp_inliers_pyramid(image_path, sigma, iterations, line_len, line_gap, threshold, factors=(4, 2),
+                           refine_threshold=None, batched=True, confidence=None, min_iterations=0, info=None,
+                           stage_cache=None, image_key=None, line_reduction=None, solver="sequential", workers=None,
+                           progress=None, cancel=None, rng=None, workspace=None, min_level_side=16):
+    # solver="joint" applies to the coarse level; refinement passes already score few lines.
+    # Factors that would shrink the image below min_level_side pixels raise ValueError.
+    # Progress events (see report_pass) carry the downscale factor of their level.
+    if solver not in SOLVERS:
+        raise ValueError(f"unknown VP solver: {solver}")
+    if stage_cache is None:
+        stage_cache = StageCache(max_images=0)
+    if refine_threshold is None:
+        refine_threshold = 3 * threshold
+    ransac = run_line_ransac_batched if batched else run_line_ransac
+    timings = {}
+    image = stage_cache.get_or_compute(image_key, "image", lambda: read_image(image_path))
+    gray = timed(timings, "grayscale", lambda: stage_cache.get_or_compute(image_key, "gray",
+                                                                         lambda: get_grayscale(image)))
+    factors = sorted(set(int(factor) for factor in factors), reverse=True)
+    if not factors or factors[-1] < 1:
+        raise ValueError("pyramid factors must be positive integers")
+    if min(gray.shape[:2]) // factors[0] < min_level_side:
+        raise ValueError(f"pyramid factor {factors[0]} is too large for a {gray.shape[1]}x{gray.shape[0]} image: "
+                         f"levels must keep at least {min_level_side} pixels per side")
+    levels = []
+    hypothesis_list = None
+    for level_index, factor in enumerate(factors):
+        edges, lines = get_level_lines(gray, factor, sigma, line_len, line_gap, timings, stage_cache, image_key, rng)
+        line_count = int(lines.shape[0])
+        weights = None
+        if line_reduction is not None:
+            lines, weights = timed(timings, f"line_reduction_x{factor}",
+                                   lambda: reduce_lines(lines, **line_reduction))
+        if hypothesis_list is None and solver == "joint":
+            joint_info = {}
+            hypothesis_list, inlier_lines_list = timed(timings, f"ransac_x{factor}_joint", lambda: run_multi_vp_ransac(
+                lines, iterations, threshold, weights=weights, info=joint_info, workers=workers, cancel=cancel,
+                rng=rng))
+            hypothesis_list = [None if hypothesis is None else hypothesis / hypothesis[-1]
+                               for hypothesis in hypothesis_list]
+            candidate_counts = [int(lines.shape[0])] * 3
+            pass_iterations = joint_info['iterations']
+            if progress is not None:
+                for pass_index, (hypothesis, inliers) in enumerate(zip(hypothesis_list, inlier_lines_list)):
+                    report_pass(progress, pass_index + 1, hypothesis, inliers, iterations, level=factor)
+        else:
+            assigned = np.zeros(lines.shape[0], dtype=bool)
+            inlier_lines_list = []
+            new_hypotheses = []
+            pass_iterations = []
+            candidate_counts = []
+            for pass_index in range(3):
+                if cancel is not None and cancel.is_set():
+                    raise Cancelled()
+                candidates = ~assigned
+                if hypothesis_list is not None and hypothesis_list[pass_index] is not None and lines.shape[0]:
+                    origins = lines[:, 0]
+                    directions = lines[:, 1] - lines[:, 0]
+                    near = get_inlier_matrix(hypothesis_list[pass_index][None], origins, directions,
+                                             np.linalg.norm(directions, axis=1),
+                                             np.cos(refine_threshold * np.pi / 180))[0]
+                    candidates &= near
+                candidate_index = np.nonzero(candidates)[0]
+                pass_info = {}
+                batched_options = {"progress": report_hypothesis(progress, pass_index + 1, level=factor),
+                                   "cancel": cancel, "workspace": workspace} if batched else {}
+                hypothesis, subset_inliers = timed(timings, f"ransac_x{factor}_pass_{pass_index + 1}", lambda: ransac(
+                    lines[candidate_index], iterations, threshold, confidence=confidence,
+                    min_iterations=min_iterations, info=pass_info,
+                    weights=None if weights is None else weights[candidate_index], rng=rng, **batched_options))
+                inliers = np.zeros(lines.shape[0], dtype=bool)
+                if hypothesis is not None:
+                    hypothesis = hypothesis / hypothesis[-1]
+                    inliers[candidate_index[subset_inliers]] = True
+                elif hypothesis_list is not None:
+                    hypothesis = hypothesis_list[pass_index]  # Keep the coarser estimate
+                assigned |= inliers
+                inlier_lines_list.append(inliers)
+                new_hypotheses.append(hypothesis)
+                pass_iterations.append(pass_info.get('iterations', 0))
+                candidate_counts.append(int(candidate_index.shape[0]))
+                if progress is not None:
+                    report_pass(progress, pass_index + 1, hypothesis, inliers, pass_info.get('iterations', 0),
+                                level=factor)
+            hypothesis_list = new_hypotheses
+        level = {"factor": factor, "lines": line_count, "candidate_lines": candidate_counts,
+                 "iterations": pass_iterations}
+        if line_reduction is not None:
+            level["reduced_lines"] = int(lines.shape[0])
+        levels.append(level)
+    if info is not None:
+        info['iterations'] = levels[-1]['iterations']
+        info['lines'] = levels[-1]['lines']
+        if line_reduction is not None:
+            info['reduced_lines'] = levels[-1]['reduced_lines']
+        info['levels'] = levels
+        info.setdefault('timings', {}).update(timings)
+    return inlier_lines_list, hypothesis_list, image, edges, lines
+
+class VanishingPointPipeline:
+    # Vanishing point detection with a fixed configuration: the get_vp_inliers parameters, plus
+    # pyramid factors for the coarse-to-fine search (get_vp_inliers_pyramid). The pipeline keeps a
+    # random generator, seeded for reproducible results, a Workspace for the RANSAC buffers and a
+    # StageCache across calls, so repeated detections do not rebuild them. Not thread-safe: use one
+    # pipeline per thread.
+    def __init__(self, sigma=5.0, iterations=3000, line_len=11, line_gap=7, threshold=2.0, seed=None,
+                 stage_cache=None, **options):
+        self.config = dict(sigma=sigma, iterations=iterations, line_len=line_len, line_gap=line_gap,
+                           threshold=threshold, **options)
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+        self.workspace = Workspace()
+        self.stage_cache = StageCache() if stage_cache is None else stage_cache
+
+    # Same values as get_vp_inliers for an image path or decoded array; keyword arguments override
+    # the configuration for this call only
+    def detect(self, image, image_key=None, info=None, progress=None, cancel=None, **overrides):
+        config = dict(self.config, **overrides)
+        args = [config.pop(name) for name in ("sigma", "iterations", "line_len", "line_gap", "threshold")]
+        pyramid = config.pop("pyramid", None)
+        vp_inliers = get_vp_inliers
+        if pyramid:
+            vp_inliers = get_vp_inliers_pyramid
+            config['factors'] = pyramid
+        return vp_inliers(image, *args, info=info, stage_cache=self.stage_cache, image_key=image_key,
+                          progress=progress, cancel=cancel, rng=self.rng, workspace=self.workspace, **config)
+
+# One pipeline per worker thread, sharing the process stage cache. GLASSFINDER_VP_SEED seeds the
+# first one, and later ones get the following seeds, for reproducible worker results.
+vp_seed = int(os.environ["GLASSFINDER_VP_SEED"]) if os.environ.get("GLASSFINDER_VP_SEED") else None
+worker_pipelines = threading.local()
+worker_pipeline_count = 0
+worker_pipeline_lock = threading.Lock()
+
+def get_worker_pipeline():
+    global worker_pipeline_count
+    pipeline = getattr(worker_pipelines, "pipeline", None)
+    if pipeline is None:
+        with worker_pipeline_lock:
+            seed = None if vp_seed is None else vp_seed + worker_pipeline_count
+            worker_pipeline_count += 1
+        pipeline = worker_pipelines.pipeline = VanishingPointPipeline(seed=seed, stage_cache=stage_cache)
+    return pipeline
+
+# Picklable entry point for worker processes: takes the encoded upload (decoded here, at most max_side
+# pixels on its longest side) or a decoded array, and only sends back the vanishing points, in
+# original image pixels, and the pass info. With `progress` (e.g. the put method of a queue shared
+# with the caller) the progress events are sent as they happen, with vanishing points as {"x", "y"}
+# in original image pixels; setting the `cancel` event stops the search with Cancelled. Other keyword
+# arguments are VanishingPointPipeline options, e.g. pyramid.
+def compute_vanishing_points(image, sigma, iterations, line_len, line_gap, threshold, image_key=None, max_side=None,
+                             scale=1.0, progress=None, **kwargs):
+    if image_key is not None and max_side:
+        image_key = f"{image_key}@{max_side}"
+    info = {'timings': {}}
+    if isinstance(image, bytes):
+        image, scale = timed(info['timings'], "decode", lambda: stage_cache.get_or_compute(
+            image_key, "decoded", lambda: decode_image(image, max_side)))
+    if progress is not None:
+        send = progress
+        def progress(event):
+            vp = event["vanishing_point"]
+            send(dict(event, vanishing_point=None if vp is None else {"x": float(vp[0] / scale),
+                                                                       "y": float(vp[1] / scale)}))
+    info['megapixels'] = image.shape[0] * image.shape[1] / scale ** 2 / 1e6
+    _, hypothesis_list, _, _, _ = get_worker_pipeline().detect(
+        image, image_key=image_key, info=info, progress=progress, sigma=sigma, iterations=iterations,
+        line_len=line_len, line_gap=line_gap, threshold=threshold, **kwargs)
+    if scale != 1.0:
+        hypothesis_list = [None if vp is None else np.append(vp[:2] / scale, vp[2]) for vp in hypothesis_list]
+    return hypothesis_list, info
+
 def save_visualizations(image, edges, lines, inlier_lines_list, hypothesis_list, colors):
+    # Only needed for debugging output, and slow to import
+    import matplotlib.pyplot as plt
+    from matplotlib import cm
+
     fig, ax = plt.subplots(figsize=(10, 10))
     ax.imshow(image, cmap=cm.gray)
 
@@ -79,7 +716,8 @@ def save_visualizations(image, edges, lines, inlier_lines_list, hypothesis_list,
             ax.plot((p0[0], p1[0]), (p0[1], p1[1]), colors[i])
 
         vp = hypothesis_list[i]
-        ax.plot([vp[0]], [vp[1]], colors[i] + 'X', markersize=10)
+        if vp is not None:
+            ax.plot([vp[0]], [vp[1]], colors[i] + 'X', markersize=10)
 
     plt.axis('off')
     temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".png")